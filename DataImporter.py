@@ -19,32 +19,108 @@ Test for the construction of a data set:
 
 import argparse
 import sys
+import os
 import datetime
 from time import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from traceback import format_exc
 import pandas as pd
 
 import HavvarselFrostImporter
+import HavvarselStore
+import Imputer
 import FrostImporter
 import NorKystImporter
 import PPImporter
+import HttpClient
+import Instrumentation
+import ThreddsCache
+import ThreddsManifest
+import DatasetWriter
+import IOArchive
+import TimeAligner
+import ThreddsUtils
 
 class DataImporter:
-    def __init__(self, station_id=None, start_time=None, end_time=None):
+    # the data sources (in the order their columns are added to the dataset)
+    SOURCES = ["havvarsel", "frost", "norkyst", "pp"]
+
+    FROST_PARAMS = ["air_temperature", "wind_speed", "cloud_area_fraction",\
+        "mean(solar_irradiance PT1H)", "sum(duration_of_sunshine PT1H)", \
+        "mean(relative_humidity PT1H)", "mean(surface_downwelling_shortwave_flux_in_air PT1H)"]
+    # number of closest Frost stations per param
+    FROST_NS = [4, 3, 3, 1, 2, 2, 1]
+
+    PP_PARAMS = ['air_temperature_2m', 'wind_speed_10m', 'wind_direction_10m','precipitation_amount',\
+        'cloud_area_fraction', 'integral_of_surface_downwelling_shortwave_flux_in_air_wrt_time']
+
+    def __init__(self, station_id=None, start_time=None, end_time=None, cache_dir=None, store_dir=None, format="csv",
+            archive_dir=None, archive_mode="replay", workers=4, allow_partial=False):
         """ Initialisation of DataImporter Class
         If nothing is specified as argument, command line arguments are expected.
         Otherwise an empty instance of the class is created
+        cache_dir: if given, the slices fetched from THREDDS are cached locally in this directory
+        store_dir: if given, the Havvarsel Frost observations are synced incrementally into this directory
+        format: format of the dataset file ("csv", "parquet" or "feather", see DatasetWriter)
+        archive_dir: if given, all remote I/O is recorded into (archive_mode "record") 
+            or replayed from (archive_mode "replay") this directory (see IOArchive)
+        workers: number of worker processes reading the THREDDS files per source (see ThreddsUtils.read_files)
+        allow_partial: if True, the dataset is written even if a source other than Havvarsel Frost fails
+            (the failures are returned by constructDataset), otherwise such a failure is raised
         """
+        if archive_dir is not None:
+            IOArchive.configure(archive_dir, archive_mode)
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ThreddsCache.ThreddsCache(cache_dir)
+        self.store = None
+        if store_dir is not None:
+            self.store = HavvarselStore.HavvarselStore(store_dir)
+        # imputation of missing observations and the masks of the imputed values
+        self.imputer = Imputer.Imputer("nearest")
+        self.imputed = {}
+        # writer for the dataset file
+        self.writer = DatasetWriter.DatasetWriter(format)
+        # catalog of the existing THREDDS files
+        self.manifest = ThreddsManifest.ThreddsManifest()
+        # locations of the data sources (can point to local copies or mock servers)
+        self.havvarsel_api_base = "https://havvarsel-frost.met.no"
+        self.frost_api_base = "https://frost.met.no"
+        self.norkyst_filename_format = "https://thredds.met.no/thredds/dodsC/fou-hi/norkyst800m-1h/NorKyst-800m_ZDEPTHS_his.an.%Y%m%d00.nc"
+        self.pp_archive_url = "https://thredds.met.no/thredds/dodsC"
+        # timeouts in seconds for fetching from the sources (None for no timeout)
+        # NOTE: A source that times out is not stopped (its thread keeps running until it is done)
+        self.timeouts = {"havvarsel": None, "frost": None, "norkyst": None, "pp": None}
+        self.workers = workers
+        self.allow_partial = allow_partial
+        # matching of the times of the sources to the dataset times (method and tolerance, see TimeAligner.add):
+        # the hourly series match exactly, the Frost observations are matched to the nearest time within half an hour
+        self.alignment = {"havvarsel": {"method": None, "tolerance": None},
+                          "frost": {"method": "nearest", "tolerance": pd.Timedelta(minutes=30)},
+                          "norkyst": {"method": None, "tolerance": None},
+                          "pp": {"method": None, "tolerance": None}}
 
         # For command line calls the class reads the parameters from argsPars
         if start_time is None:
-            station_id, start_time, end_time = self.__parse_args()
+            station_id, start_time, end_time, cache_dir, store_dir, format, extend, record_dir, replay_dir, \
+                self.workers, self.allow_partial = self.__parse_args()
+
+            if cache_dir is not None:
+                self.cache = ThreddsCache.ThreddsCache(cache_dir)
+            if store_dir is not None:
+                self.store = HavvarselStore.HavvarselStore(store_dir)
+            self.writer = DatasetWriter.DatasetWriter(format)
+            if record_dir is not None:
+                IOArchive.configure(record_dir, "record")
+            elif replay_dir is not None:
+                IOArchive.configure(replay_dir, "replay")
 
             self.start_time = datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
             self.end_time = datetime.datetime.strptime(end_time, "%Y-%m-%dT%H:%M")
 
             # Construct dataset
-            self.constructDataset(station_id)
+            self.constructDataset(station_id, extend)
 
         
         # Non-command line calls expect start and end_time to initialise a valid instance
@@ -53,185 +129,411 @@ class DataImporter:
             self.end_time = datetime.datetime.strptime(end_time, "%Y-%m-%dT%H:%M")
 
 
-    def constructDataset(self, station_id):
+    def constructDataset(self, station_id, extend=False):
         """ construct a csv file containing the water_temperature series of the selected station of havvarsel frost
-        and adds params time series from the n closest frost stations
-        """
+        and adds params time series from the n closest frost stations.
+        With extend an existing dataset of the station is extended - 
+        only the time ranges that are missing per source are fetched (see missing_ranges).
+        If a source fails (or times out) an exception is raised, 
+        unless partial datasets are allowed (self.allow_partial), then the dataset is written without that source.
+        Returns the failures (error messages) by source"""
+        # NOTE: The instrumentation and the HTTP client are shared by the process (like for several stations),
+        # the run summary only counts this dataset (what happened after the snapshots)
+        instrumentation = Instrumentation.default()
+        since, http_since = instrumentation.snapshot(), HttpClient.default().snapshot()
+        try:
+            return self.__construct(station_id, extend, since, http_since)
+        finally:
+            # NOTE: Worker processes (like in run_download) may end without the flush at exit
+            instrumentation.flush()
+
+
+    def __construct(self, station_id, extend, since, http_since):
         self.__log("-------------------------------------------")
         self.__log("Starting the construction of an data set...")
         self.__log("-------------------------------------------")
+        instrumentation = Instrumentation.default()
 
         #########################################################
         times = pd.date_range(self.start_time, self.end_time, freq="H")
         times = times.tz_localize("UTC")
-        data = pd.DataFrame(times, columns=["time"])
-        
-        #########################################################
-        # meta data and time series from havvarsel frost
-        havvarselFrostImporter = HavvarselFrostImporter.HavvarselFrostImporter(self.start_time, self.end_time)
-        self.__log("The Havvarsel Frost observation site:")
-        location, timeseries = havvarselFrostImporter.data(station_id)
-
-        timeseries = timeseries.reset_index()
-        data = pd.merge(data.set_index("time"), timeseries.set_index("time"), how="left", on="time")
 
         if True:
             self.__log("The data fetching is restricted to the range when swimming temperatures are available")
-            self.start_time = data.index[0].to_pydatetime().replace(tzinfo=None)
-            self.end_time = data.index[-1].to_pydatetime().replace(tzinfo=None)
-        self.__log("-------------------------------------------")
+            self.start_time = times[0].to_pydatetime().replace(tzinfo=None)
+            self.end_time = times[-1].to_pydatetime().replace(tzinfo=None)
+
+        # time ranges to fetch per source
+        existing = None
+        if extend and os.path.exists(self.writer.path("dataset_"+station_id)):
+            existing = DatasetWriter.load_dataset(self.writer.path("dataset_"+station_id))
+            ranges = self.missing_ranges(existing, times)
+        else:
+            ranges = {source: [(self.start_time, self.end_time)] for source in self.SOURCES}
 
         #########################################################
+        # NOTE: Only the location of the Havvarsel Frost site is needed for the other sources,
+        # those are fetched concurrently as soon as it is known
+        tasks = {"havvarsel": (lambda: self.__havvarsel_ranges(station_id, ranges["havvarsel"]), [], self.timeouts["havvarsel"])}
         # time series from frost
         if False:
-            frost_params = ["air_temperature", "wind_speed", "cloud_area_fraction",\
-                "mean(solar_irradiance PT1H)", "sum(duration_of_sunshine PT1H)", \
-                "mean(relative_humidity PT1H)", "mean(surface_downwelling_shortwave_flux_in_air PT1H)"]
-            frost_ns = [4, 3, 3, 1, 2, 2, 1]
-
-            frostImporter = FrostImporter.FrostImporter(start_time=self.start_time, end_time=self.end_time)
-            for ip in range(len(frost_params)):
-                param = frost_params[ip]
-                n = int(frost_ns[ip])
-                self.__log("-------------------------------------------")
-                self.__log("Frost element: "+param+".")
-                self.__log("-------------------------------------------")
-                # identifying closest station_id's on frost
-                self.__log("The closest "+str(n)+" Frost stations:")
-                frost_station_ids = frostImporter.location_ids(location, n, param)
-                self.__log("-------------------------------------------")
-                # Fetching data for those ids and add them to data
-                for i in range(len(frost_station_ids)):
-                    # NOTE: Per call a maximum of 100.000 observations can be fetched at once
-                    # Some time series exceed this limit.
-                    # TODO: Fetch data year by year to stay within the limit 
-                    self.__log("Fetching data for "+ str(frost_station_ids[i]))
-                    timeseries = frostImporter.data(frost_station_ids[i],param)
-                    if timeseries is not None:
-                        self.__log("Postprocessing the fetched data...")
-                        data = self.left_join(timeseries,frost_station_ids[i],param,data)
-                self.__log("-------------------------------------------")
-
-
-        #########################################################
+            tasks["frost"] = (lambda havvarsel: [self.__frost_data(havvarsel[0], s, e) for s, e in ranges["frost"]], 
+                                ["havvarsel"], self.timeouts["frost"])
         # time series from THREDDS norkyst
-        self.__log("Fetching data from THREDDS")
-        depth=[0,3,10]
-
-        norkystImporter = NorKystImporter.NorKystImporter(self.start_time, self.end_time)
-        timeseries = norkystImporter.norkyst_data("temperature", 
-                        float(location["lon"][0]), float(location["lat"][0]), depth=depth)
-
-        timeseries = timeseries.rename(columns={"referenceTime":"time"})
-        for c in timeseries.columns:
-            if isinstance(c, str):
-                if c.startswith("temperature"):
-                    timeseries = timeseries.rename(columns={c:c.replace("temperature", "norkyst_water_temp")})
-
-        data = data.reset_index()
-        data = pd.merge(data.set_index("time"), timeseries.set_index("time"), how="left", on="time")
-
-        self.__log("-------------------------------------------")
-
+        tasks["norkyst"] = (lambda havvarsel: [self.__norkyst_data(havvarsel[0], s, e) for s, e in ranges["norkyst"]], 
+                                ["havvarsel"], self.timeouts["norkyst"])
+        # time series from THREDDS post-processed forecast
+        tasks["pp"] = (lambda havvarsel: [self.__pp_data(havvarsel[0], s, e) for s, e in ranges["pp"]], 
+                                ["havvarsel"], self.timeouts["pp"])
+
+        if existing is not None:
+            for source in tasks.keys():
+                self.__log("Missing for " + source + ": " 
+                    + (", ".join(str(s) + " - " + str(e) for s, e in ranges[source]) if len(ranges[source]) > 0 else "nothing"))
+
+        with instrumentation.span("fetch"):
+            results, failures = self.schedule(tasks)
+        for name, err in failures.items():
+            self.__log("Fetching from " + name + " failed: " + err)
+        if "havvarsel" not in results:
+            raise Exception(failures["havvarsel"])
+        if len(failures) > 0 and not self.allow_partial:
+            raise Exception("Fetching failed for " + ", ".join(failures.keys()) + " (see allow_partial): " 
+                + "; ".join(name + ": " + err for name, err in failures.items()))
+        
+        location, havvarsel_timeseries = results["havvarsel"]
 
         #########################################################
-        # time series from THREDDS post-processed forecast
-        pp_params = ['air_temperature_2m', 'wind_speed_10m', 'wind_direction_10m','precipitation_amount',\
-            'cloud_area_fraction', 'integral_of_surface_downwelling_shortwave_flux_in_air_wrt_time']
+        with instrumentation.span("join"):
+            # NOTE: All time series are written into one preallocated set of columns (see TimeAligner),
+            # with an existing dataset its values come first and are replaced by the fetched values
+            if existing is not None:
+                aligner = TimeAligner.TimeAligner(times.union(existing.index), existing.drop(columns=["index"], errors="ignore"))
+            else:
+                aligner = TimeAligner.TimeAligner(times)
+
+            # adding the fetched time series to the dataset (in a fixed order)
+            for timeseries in havvarsel_timeseries:
+                aligner.add(timeseries, [c for c in timeseries.columns if c not in ["time", "index"]], 
+                    **self.alignment["havvarsel"])
+
+            if "frost" in results and len(results["frost"]) > 0:
+                # NOTE: The Frost observations are imputed only within the range they are fetched for
+                for (s, e), frost_data in zip(ranges["frost"], results["frost"]):
+                    for timeseries, frost_station_id, param in frost_data:
+                        self.__log("Postprocessing the fetched data for " + frost_station_id + " and " + param + "...")
+                        self.left_join(timeseries, frost_station_id, param, aligner, s, e)
+                self.__log("-------------------------------------------")
 
-        self.__log("Fetching data from THREDDS")
-        ppImporter = PPImporter.PPImporter(self.start_time, self.end_time)
-        timeseries = ppImporter.pp_data(pp_params, float(location["lon"][0]), float(location["lon"][0]), self.start_time, self.end_time)
+            for timeseries in results.get("norkyst", []):
+                aligner.add(timeseries, [c for c in timeseries.columns if c not in ["time", "index"]], 
+                    **self.alignment["norkyst"])
 
-        #NOTE: The timezone is manually set for THREDDS observations 
-        # (this reduces calculation overhead since otherwise it would be handled as missing data
-        # however it would be imputed with the right values)
-        self.__log("Postprocessing the fetched data...")
+            if "pp" in results and len(results["pp"]) > 0:
+                #NOTE: The timezone is manually set for THREDDS observations 
+                # (this reduces calculation overhead since otherwise it would be handled as missing data
+                # however it would be imputed with the right values)
+                self.__log("Postprocessing the fetched data...")
+                for timeseries in results["pp"]:
+                    aligner.add(timeseries, [c for c in timeseries.columns if c not in ["time", "index"]], 
+                        **self.alignment["pp"])
 
-        timeseries = timeseries.reset_index()
-        timeseries = timeseries.rename(columns={"referenceTime":"time"})
-        
-        data = data.reset_index()
-        data = pd.merge(data.set_index("time"), timeseries.set_index("time")[pp_params], how="left", on="time")
+            data = aligner.frame()
 
+        if self.cache is not None:
+            self.__log(self.cache.stats())
         self.__log("-------------------------------------------")
 
 
         #########################################################
         # save dataset
+        self.__log(HttpClient.default().summary(since=http_since))
         self.__log("Dataset is constructed and will be saved now...")
-        data.to_csv("dataset_"+station_id+".csv")
+        with instrumentation.span("write"):
+            self.writer.write(data, "dataset_"+station_id)
+
+        # NOTE: The summary shows where the time of the run goes (spans) and how much is read (counters)
+        instrumentation.write_summary("run_summary_"+station_id+".json", since=since, station_id=station_id, 
+            failures=failures, http=HttpClient.default().stats_since(http_since))
         self.__log("Ready!")
 
+        return failures
+
+
+    def source_columns(self, columns):
+        """Columns of a dataset per source"""
+        sources = {source: [] for source in self.SOURCES}
+        for c in columns:
+            if c == "index":
+                continue
+            elif c == "water_temp":
+                sources["havvarsel"].append(c)
+            elif c.startswith("norkyst_water_temp"):
+                sources["norkyst"].append(c)
+            elif c in self.PP_PARAMS:
+                sources["pp"].append(c)
+            else:
+                sources["frost"].append(c)
+        return sources
+
+
+    def missing_ranges(self, existing, times):
+        """Time ranges [(start_time, end_time)] within times that are not covered by the existing dataset per source.
+        A source covers the times between its first and last observation in the dataset 
+        (gaps in between are missing observations that would not be there after fetching again)"""
+        one_hour = pd.Timedelta(hours=1)
+        ranges = {}
+        for source, columns in self.source_columns(existing.columns).items():
+            if len(columns) > 0:
+                observed = existing.index[existing[columns].notna().any(axis=1).values]
+            else:
+                observed = []
+
+            if len(observed) == 0:
+                source_ranges = [(times[0], times[-1])]
+            else:
+                source_ranges = []
+                if times[0] < observed[0]:
+                    source_ranges.append((times[0], min(observed[0] - one_hour, times[-1])))
+                if times[-1] > observed[-1]:
+                    source_ranges.append((max(observed[-1] + one_hour, times[0]), times[-1]))
+
+            ranges[source] = [(s.tz_convert("UTC").tz_localize(None).to_pydatetime(), 
+                               e.tz_convert("UTC").tz_localize(None).to_pydatetime()) for s, e in source_ranges]
+        return ranges
+
     
-    def left_join(self, timeseries, station_id, param, data):
+    def left_join(self, timeseries, station_id, param, data, start_time=None, end_time=None):
         """Preparing the new timeseries for a join by imputing missing data, and 
-        FROM data LEFT JOIN ts(=prepared timeseries) ON time=time"""
+        FROM data LEFT JOIN ts(=prepared timeseries) ON time=time
+        data: TimeAligner that gets the new columns 
+            or data frame with the times in the column or index "time" (then the joined data frame is returned)
+        start_time, end_time: only the times of data within [start_time, end_time] are joined (None for no limit)"""
+
+        if isinstance(data, TimeAligner.TimeAligner):
+            aligner = data
+        else:
+            if "time" in data.columns:
+                data = data.set_index("time")
+            aligner = TimeAligner.TimeAligner(data.index, data.drop(columns=["index"], errors="ignore"))
+
+        times = aligner.times
+        if start_time is not None:
+            times = times[times >= ThreddsUtils.utc(start_time)]
+        if end_time is not None:
+            times = times[times <= ThreddsUtils.utc(end_time)]
 
         # NOTE: The Frost data commonly holds observations for more times 
         # than the referenced Havvarsel Frost timeseries.
         # Extracting observations only for times that exist in Havvarsel Frost
-        if "time" not in data.columns:
-            data = data.reset_index()
-        ts = timeseries.loc[timeseries['referenceTime'].isin(data["time"])]
+        ts = timeseries.loc[timeseries['referenceTime'].isin(times)]
 
         # NOTE: The Frost time series may misses observations 
         # at times which are present in the Havvarsel timeseries
-        if len(data)>len(ts):
+        if len(times)>len(ts):
             self.__log("The time series misses observation(s)...")
-            ts = self.imput_missing_data(data, timeseries, ts)
+            ts = self.imput_missing_data(pd.DataFrame({"time": times}), timeseries, ts, label=station_id+param)
 
         # NOTE: The Frost data can contain data for different "levels" for a parameter
         cols_param = [s for s in ts.columns if param.lower() in s]
 
-        # LEFT JOIN to add new observations 
-        # Join performed on "time", this makes "time" the index
-        ts = ts.rename(columns={"referenceTime":"time"})
-        data = data.reset_index()
-        data = pd.merge(data.set_index("time"), ts.set_index("time")[cols_param], how="left", on="time")
-        data = data.drop(columns=["index"])
-        
-        # Renaming new columns
-        for i in range(len(cols_param)):
-            data.rename(columns={cols_param[i]:station_id+param+str(i)}, inplace=True)
+        # Adding the new columns (named by station, param and level) at their times
+        aligner.add(ts, cols_param, time_col="referenceTime", 
+            names=[station_id+param+str(i) for i in range(len(cols_param))], start_time=start_time, end_time=end_time,
+            **self.alignment["frost"])
         self.__log("Data is added to the data set")
 
-        return data
+        if aligner is data:
+            return aligner
+        return aligner.frame()
 
 
-    def imput_missing_data(self, data, timeseries,ts):
+    def imput_missing_data(self, data, timeseries, ts, label=None):
         """Missing observations in ts are imputed 
-        with the value of the nearest temporal neighbor in timeseries
-        such that for all times in data an original or faked observation exists"""
-            
-        missing = data[~data["time"].isin(timeseries["referenceTime"])]["time"]
-        # Find closest observation for times in missing
-        # And construct dataframe to fill with
-        fill = pd.DataFrame()
-        for t in missing:
-            # Ensuring pd.datetime in timeseries dataframe 
-            if "referenceTime" in timeseries.columns:
-                timeseries["referenceTime"] = pd.to_datetime(timeseries["referenceTime"])
-                timeseries = timeseries.set_index("referenceTime")
-
-            row = timeseries.iloc[[timeseries.index.get_loc(t, method="nearest")]]
-            row = row.reset_index()
-            row["referenceTime"] = t
-
-            fill = fill.append(row)
-
-        fill = fill.set_index("referenceTime")
-        fill = fill.reset_index()
-
-        # Attaching "fake observations" to relevant timeseries
-        ts = ts.append(fill)
-        ts = ts.reset_index()
+        with the value of the nearest temporal neighbor in timeseries (see Imputer)
+        such that for all times in data an original or faked observation exists.
+        The mask of the imputed values is kept in self.imputed[label]"""
+
+        ts, imputed = self.imputer.impute(timeseries, data["time"], "referenceTime")
+        if label is not None:
+            self.imputed[label] = imputed
 
         self.__log("Missing observations have been filled with the value from the closest neighbor.")
 
         return ts
 
 
+    def schedule(self, tasks):
+        """Runs the tasks {name: (function, dependencies, timeout)} concurrently, 
+        where a task starts as soon as all its dependencies are finished 
+        and gets the results of the dependencies as arguments (in the given order).
+        A task that fails (or exceeds its timeout in seconds) is reported in the failures
+        and the tasks depending on it are not run.
+        Returns the results and the failures (error messages) by name"""
+        for name, (_, dependencies, _) in tasks.items():
+            unknown = [d for d in dependencies if d not in tasks]
+            if len(unknown) > 0:
+                raise ValueError("Task " + name + " depends on the unknown task(s) " + ", ".join(unknown))
+
+        results, failures = {}, {}
+        pending = dict(tasks)
+        running = {}
+
+        executor = ThreadPoolExecutor(max_workers=max(len(tasks), 1))
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                # starting all tasks whose dependencies are finished
+                for name, (function, dependencies, timeout) in list(pending.items()):
+                    if any(d in failures for d in dependencies):
+                        failures[name] = "Skipped since " + ", ".join(d for d in dependencies if d in failures) + " failed"
+                        del pending[name]
+                    elif all(d in results for d in dependencies):
+                        future = executor.submit(self.__run_task, name, function, *[results[d] for d in dependencies])
+                        deadline = None if timeout is None else time() + timeout
+                        running[future] = (name, deadline)
+                        del pending[name]
+
+                if len(running) == 0:
+                    if len(pending) > 0:
+                        # NOTE: Nothing runs and nothing can be started (the dependencies are cyclic)
+                        raise ValueError("Cyclic dependencies between the tasks " + ", ".join(pending.keys()))
+                    continue
+
+                deadlines = [deadline for _, deadline in running.values() if deadline is not None]
+                wait_time = None if len(deadlines) == 0 else max(min(deadlines) - time(), 0)
+                done, _ = wait(running.keys(), timeout=wait_time, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name, _ = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as err:
+                        failures[name] = repr(err)
+
+                # NOTE: A running thread cannot be stopped, its result is just ignored
+                for future, (name, deadline) in list(running.items()):
+                    if deadline is not None and time() > deadline:
+                        failures[name] = "Timeout after " + str(tasks[name][2]) + "s"
+                        del running[future]
+        finally:
+            # NOTE: shutdown(cancel_futures=True) is not available in Python 3.7
+            for future in running.keys():
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        return results, failures
+
+
+    @staticmethod
+    def __run_task(name, function, *args):
+        with Instrumentation.default().span(name):
+            return function(*args)
+
+
+    def __havvarsel_ranges(self, station_id, ranges):
+        """Location and the time series of the Havvarsel Frost site for all ranges"""
+        if len(ranges) == 0:
+            # NOTE: The location is needed for the other sources even if no observations are missing
+            location, _ = self.__havvarsel_data(station_id, self.end_time - datetime.timedelta(days=1), self.end_time)
+            return location, []
+
+        timeseries = []
+        for start_time, end_time in ranges:
+            location, ts = self.__havvarsel_data(station_id, start_time, end_time)
+            timeseries.append(ts)
+        return location, timeseries
+
+
+    def __havvarsel_data(self, station_id, start_time, end_time):
+        """Location and the time series of the Havvarsel Frost site"""
+        havvarselFrostImporter = HavvarselFrostImporter.HavvarselFrostImporter(start_time, end_time)
+        self.__log("The Havvarsel Frost observation site:")
+        if self.store is not None:
+            # NOTE: Only the observations that are not in the store yet are fetched
+            self.store.importer = havvarselFrostImporter
+            self.store.frost_api_base = self.havvarsel_api_base
+            location, timeseries = self.store.sync([station_id], start_time, end_time)[str(station_id)]
+            self.__log(location.to_string())
+        else:
+            location, timeseries = havvarselFrostImporter.data(station_id, frost_api_base=self.havvarsel_api_base)
+        self.__log("-------------------------------------------")
+
+        timeseries = timeseries.reset_index()
+
+        return location, timeseries
+
+
+    def __frost_data(self, location, start_time, end_time):
+        """Time series of the Frost stations closest to location 
+        as list of (timeseries, station_id, param)"""
+        frost_params = self.FROST_PARAMS
+        frost_ns = self.FROST_NS
+
+        frostImporter = FrostImporter.FrostImporter(start_time=start_time, end_time=end_time, frost_api_base=self.frost_api_base)
+        frost_station_ids = {}
+        for ip in range(len(frost_params)):
+            param = frost_params[ip]
+            n = int(frost_ns[ip])
+            self.__log("-------------------------------------------")
+            self.__log("Frost element: "+param+".")
+            self.__log("-------------------------------------------")
+            # identifying closest station_id's on frost
+            self.__log("The closest "+str(n)+" Frost stations:")
+            frost_station_ids[param] = list(frostImporter.location_ids(location, n, param))
+            self.__log("-------------------------------------------")
+
+        # Fetching data for all those ids and params at once 
+        # NOTE: Per call a maximum of 100.000 observations can be fetched at once
+        # Some time series exceed this limit, FrostImporter plans the requests accordingly
+        all_station_ids = [station_id for param in frost_params for station_id in frost_station_ids[param]]
+        self.__log("Fetching data for "+ ", ".join(dict.fromkeys(all_station_ids)))
+        frost_timeseries = frostImporter.data_matrix(all_station_ids, frost_params)
+
+        frost_data = []
+        for param in frost_params:
+            for station_id in frost_station_ids[param]:
+                if (station_id, param) in frost_timeseries:
+                    frost_data.append((frost_timeseries[(station_id, param)], station_id, param))
+
+        return frost_data
+
+
+    def __norkyst_data(self, location, start_time, end_time):
+        """Time series of the NorKyst800 water temperature at location (in several depths)"""
+        self.__log("Fetching data from THREDDS")
+        depth=[0,3,10]
+
+        norkystImporter = NorKystImporter.NorKystImporter(start_time, end_time, cache=self.cache, manifest=self.manifest, 
+                            filename_format=self.norkyst_filename_format, workers=self.workers)
+        timeseries = norkystImporter.norkyst_data("temperature", 
+                        float(location["lon"][0]), float(location["lat"][0]), depth=depth)
+
+        timeseries = timeseries.rename(columns={"referenceTime":"time"})
+        for c in timeseries.columns:
+            if isinstance(c, str):
+                if c.startswith("temperature"):
+                    timeseries = timeseries.rename(columns={c:c.replace("temperature", "norkyst_water_temp")})
+
+        self.__log("-------------------------------------------")
+
+        return timeseries
+
+
+    def __pp_data(self, location, start_time, end_time):
+        """Time series of the post-processed weather forecast at location"""
+        pp_params = self.PP_PARAMS
+
+        self.__log("Fetching data from THREDDS")
+        ppImporter = PPImporter.PPImporter(start_time, end_time, cache=self.cache, manifest=self.manifest, 
+                            archive_url=self.pp_archive_url, workers=self.workers)
+        timeseries = ppImporter.pp_data(pp_params, float(location["lon"][0]), float(location["lat"][0]), start_time, end_time)
+
+        timeseries = timeseries.reset_index()
+        timeseries = timeseries.rename(columns={"referenceTime":"time"})
+
+        return timeseries[["time"] + pp_params]
+
+
     @staticmethod
     def __parse_args():
         parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -244,14 +546,39 @@ class DataImporter:
         parser.add_argument(
             '-E', '--end-time', required=True,
             help='end time in ISO format (YYYY-MM-DDTHH:MM) UTC')
+        parser.add_argument(
+            '-cache', dest='cache_dir', default=None,
+            help='cache the data fetched from THREDDS in the given directory')
+        parser.add_argument(
+            '-store', dest='store_dir', default=None,
+            help='sync the Havvarsel Frost observations incrementally into the given directory')
+        parser.add_argument(
+            '-format', default="csv", choices=DatasetWriter.FORMATS,
+            help='format of the dataset file')
+        parser.add_argument(
+            '-extend', action='store_true',
+            help='extend the existing dataset of the station (only missing time ranges are fetched)')
+        archive = parser.add_mutually_exclusive_group()
+        archive.add_argument(
+            '-record', dest='record_dir', default=None,
+            help='record all remote I/O into the given archive directory')
+        archive.add_argument(
+            '-replay', dest='replay_dir', default=None,
+            help='replay all remote I/O from the given archive directory (no network access)')
+        parser.add_argument(
+            '-workers', type=int, default=4,
+            help='number of worker processes reading the THREDDS files per source')
+        parser.add_argument(
+            '-partial', dest='allow_partial', action='store_true',
+            help='write the dataset even if a source other than Havvarsel Frost fails')
         res = parser.parse_args(sys.argv[1:])
-        return res.station_id, res.start_time, res.end_time
+        return res.station_id, res.start_time, res.end_time, res.cache_dir, res.store_dir, res.format, res.extend, \
+            res.record_dir, res.replay_dir, res.workers, res.allow_partial
 
 
     def __log(self, msg):
-        print(msg)
-        with open("log.txt", 'a') as f:
-            f.write(msg + '\n')
+        Instrumentation.default().log(msg, "DataImporter")
+
 
 if __name__ == "__main__":
 
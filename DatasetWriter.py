@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""Writing and loading the datasets constructed by DataImporter
+
+Formats:
+- "csv": text (as before, readable without further dependencies)
+- "parquet": columnar and compressed (requires pyarrow)
+- "feather": columnar and compressed, fastest to load (requires pyarrow)
+If pyarrow is not available the dataset is written as csv.
+In the columnar formats the numeric columns are stored as float32 (csv keeps the original precision),
+the time index stays tz-aware (UTC).
+
+Usage (see DataImporter):
+'path = DatasetWriter.DatasetWriter("parquet").write(data, "dataset_100")'
+'data = DatasetWriter.load_dataset("dataset_100.parquet", columns=["water_temp"], start_time="2021-06-01")'
+
+Test:
+'python3 DatasetWriter.py -f dataset_100.csv -format parquet'
+
+"""
+
+import argparse
+import sys
+import os
+from traceback import format_exc
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
+
+import ThreddsUtils
+
+
+FORMATS = ["csv", "parquet", "feather"]
+
+
+class DatasetWriter:
+    def __init__(self, format="csv", compression="zstd"):
+        """ Initialisation of DatasetWriter Class
+        format: "csv", "parquet" or "feather"
+        compression: compression of the columnar formats (like "zstd", "lz4", "snappy" or None)
+        """
+        if format not in FORMATS:
+            raise ValueError("Unknown dataset format " + str(format) + " (use one of " + ", ".join(FORMATS) + ")")
+        if format != "csv" and pyarrow is None:
+            print("pyarrow is not available, the dataset is written as csv")
+            format = "csv"
+        self.format = format
+        self.compression = compression
+
+
+    def path(self, name):
+        """File name of the dataset `name` (without extension)"""
+        return name + "." + self.format
+
+
+    def write(self, data, name):
+        """Writes the data frame (indexed by time) as dataset `name` and returns the file name.
+        The file is written to a temporary file first and then moved in place"""
+        path = self.path(name)
+        data = self.prepare(data, float32=(self.format != "csv"))
+
+        with ThreddsUtils.atomic_path(path) as tmp_path:
+            if self.format == "parquet":
+                pyarrow.parquet.write_table(pyarrow.Table.from_pandas(data, preserve_index=True), tmp_path,
+                    compression=self.compression if self.compression is not None else "none")
+            elif self.format == "feather":
+                # NOTE: Feather does not store an index, the time is stored as column
+                pyarrow.feather.write_feather(data.reset_index(), tmp_path,
+                    compression=self.compression if self.compression is not None else "uncompressed")
+            else:
+                data.to_csv(tmp_path)
+
+        return path
+
+
+    @staticmethod
+    def prepare(data, float32=True):
+        """Dataset with tz-aware (UTC) time index (and float32 numeric columns if float32)"""
+        if "time" in data.columns:
+            data = data.set_index("time")
+        data = data.drop(columns=[c for c in ["index"] if c in data.columns])
+
+        index = pd.DatetimeIndex(data.index)
+        if index.tz is None:
+            index = index.tz_localize("UTC")
+        else:
+            index = index.tz_convert("UTC")
+
+        columns = {}
+        for c in data.columns:
+            if float32 and pd.api.types.is_numeric_dtype(data[c]) and not pd.api.types.is_bool_dtype(data[c]):
+                columns[c] = data[c].values.astype(np.float32)
+            else:
+                columns[c] = data[c].values
+
+        return pd.DataFrame(columns, index=index.rename("time"), columns=list(data.columns))
+
+
+    @staticmethod
+    def __parse_args():
+        parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument(
+            '-f', dest='filename', required=True,
+            help='existing dataset')
+        parser.add_argument(
+            '-format', default="parquet", choices=FORMATS,
+            help='format to convert the dataset to')
+        res = parser.parse_args(sys.argv[1:])
+        return res.filename, res.format
+
+
+    @staticmethod
+    def main():
+        filename, format = DatasetWriter.__parse_args()
+        data = load_dataset(filename)
+        print(DatasetWriter(format).write(data, os.path.splitext(filename)[0]))
+
+
+def load_dataset(filename, columns=None, start_time=None, end_time=None):
+    """Loads a dataset written by DatasetWriter (the format is given by the extension).
+    columns: list of columns to load (None for all)
+    start_time, end_time: only the times in [start_time, end_time] are loaded (None for no limit)
+    Returns the data frame indexed by time (UTC)"""
+    start_time = ThreddsUtils.utc(start_time)
+    end_time = ThreddsUtils.utc(end_time)
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in [".parquet", ".feather"] and pyarrow is None:
+        raise ImportError("Loading the dataset " + filename + " requires pyarrow (pip install pyarrow)")
+
+    if extension == ".parquet":
+        filters = []
+        if start_time is not None:
+            filters.append(("time", ">=", start_time))
+        if end_time is not None:
+            filters.append(("time", "<=", end_time))
+        table = pyarrow.parquet.read_table(filename, columns=columns, filters=filters if len(filters) > 0 else None,
+                    use_pandas_metadata=True)
+        data = table.to_pandas()
+        # NOTE: The index is only restored automatically if all columns are read
+        if "time" in data.columns:
+            data = data.set_index("time")
+    elif extension == ".feather":
+        data = pyarrow.feather.read_feather(filename, columns=None if columns is None else ["time"] + list(columns))
+        data = data.set_index("time")
+    else:
+        data = pd.read_csv(filename, usecols=None if columns is None else ["time"] + list(columns), index_col="time")
+        data.index = pd.to_datetime(data.index, utc=True)
+
+    if start_time is not None or end_time is not None:
+        data = data.loc[start_time:end_time]
+
+    return data
+
+
+
+if __name__ == "__main__":
+
+    try:
+        DatasetWriter.main()
+    except SystemExit as e:
+        if e.code != 0:
+            print('SystemExit(code={}): {}'.format(e.code, format_exc()), file=sys.stderr)
+            sys.exit(e.code)
+    except: # pylint: disable=bare-except
+        print('error: {}'.format(format_exc()), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
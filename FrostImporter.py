@@ -20,20 +20,32 @@ import sys
 import json
 import datetime
 import requests
+import re
 import io
 from traceback import format_exc
 import pandas as pd
 import numpy as np
-from haversine import haversine 
+
+import HttpClient
+import Instrumentation
+import FrostStationCatalog
 
 
 class FrostImporter:
-    def __init__(self, station_id=None, start_time=None, end_time=None):
+    def __init__(self, station_id=None, start_time=None, end_time=None, frost_api_base="https://frost.met.no", http=None):
         """ Initialisation of DataImporter Class
         If nothing is specified as argument, command line arguments are expected.
         Otherwise an empty instance of the class is created
+        frost_api_base: url of the Frost API (can point to a local mock server as well)
+        http: HttpClient for the requests (or None for the shared client)
         """
 
+        self.frost_api_base = frost_api_base
+        self.http = http if http is not None else HttpClient.default()
+        self.catalog = FrostStationCatalog.FrostStationCatalog(frost_api_base, self.http)
+        # windows that could not be fetched: (station_id, param, start, end, error message)
+        self.failures = []
+
         # For command line calls the class reads the parameters from argsPars
         if start_time is None:
             station_id, params, start_time, end_time = self.__parse_args()
@@ -75,123 +87,294 @@ class FrostImporter:
         if end_time is None:
             end_time = self.end_time
 
-        timeseries = pd.DataFrame()
-
         # NOTE: There is a limit of 100.000 observation which can be fetched at once 
         # Hence, time series over several years are may too long
-        # As work-around: We fetch the time series year by year 
-        # TODO: Only batch the time series if necessary
-        years = end_time.year - start_time.year
-
-        for batch in range(years+1):
-            if batch == 0:
-                inter_start = start_time
-            else: 
-                inter_start = datetime.datetime.strptime(str(start_time.year+batch)+"-01-01T00:00", "%Y-%m-%dT%H:%M")
-            
-            if batch == years:
-                inter_end = end_time
-            else:
-                inter_end = datetime.datetime.strptime(str(start_time.year+batch)+"-12-31T23:59", "%Y-%m-%dT%H:%M")
-
-            
-            # Fetching data from server
-            endpoint = "https://frost.met.no" + "/observations/v0.csv"
-
-            payload = {'referencetime': inter_start.isoformat() + "Z/" + inter_end.isoformat() + "Z", 
-                        'sources': station_id, 'elements': param}
-
-            try:
-                r = requests.get(endpoint, params=payload, auth=(client_id,''))
-                self.__log("Trying " + r.url)
-                r.raise_for_status()
-                
-                # Storing in dataframe
-                df = pd.read_csv(io.StringIO(r.content.decode('utf-8')))
-                df['referenceTime'] =  pd.to_datetime(df['referenceTime'])
-                df = df.reset_index()
-
-            except requests.exceptions.HTTPError as err:
-                self.__log(str(err))
-                return(None)
-
-            timeseries = timeseries.append(df, ignore_index=True)
+        # The request is split into windows sized after the observation density of the station
+        # (and windows that still exceed the limit are split again)
+        rate = self.observation_rate(station_id, param, start_time, end_time, client_id=client_id)
+        windows = self.plan_windows(start_time, end_time, rate)
+        self.__log("Planned " + str(len(windows)) + " request(s) for " + str(station_id) + " ("
+            + ("{:.2f}".format(rate) if rate is not None else "unknown") + " observations per hour)")
+
+        # NOTE: Windows that fail are logged (see self.failures), the others are kept
+        chunks = []
+        for inter_start, inter_end in windows:
+            chunks.extend(self.__fetch_window(station_id, param, inter_start, inter_end, client_id))
+
+        if len(chunks) == 0:
+            return(None)
+        timeseries = self.concat(chunks)
         
         return(timeseries)
 
 
-    def location_ids(self, havvarsel_location, n, param, client_id='3cf0c17c-9209-4504-910c-176366ad78ba'):
-        """Used in the full DataImporter....
-        Identifying the n closest station_ids in the Frost database around havvarsel_locations
-        where havvarsel_location is given as a dataframe with latlon coordinates"""
+    def data_matrix(self, station_ids, params, start_time=None, end_time=None,\
+        client_id='3cf0c17c-9209-4504-910c-176366ad78ba', limit=100000, fill=0.9):
+        """Fetch data for all combinations of station_ids and params (elements) from standard Frost server
+        with as few combined requests (sources=...&elements=...) as the observation limit allows.
+        Returns a dict with a data frame per (station_id, param) 
+        (holding only the columns for param, pairs without observations are missing)"""
 
+        # using member variables if applicable
+        if start_time is None:
+            start_time = self.start_time
+        if end_time is None:
+            end_time = self.end_time
+
+        station_ids = list(dict.fromkeys(station_ids))
+        params = list(dict.fromkeys(params))
+
+        # Observations per hour per station (summed over all params)
+        rates = self.observation_rates(station_ids, params, start_time, end_time, client_id=client_id)
+        station_rates = {}
+        for station_id in station_ids:
+            station_rates[station_id] = sum(rates.get((station_id, param), 0.0) for param in params)
+        if len(rates) > 0:
+            # stations without any of the params are not requested
+            station_ids = [station_id for station_id in station_ids if station_rates[station_id] > 0]
+
+        # NOTE: A combined request returns all params for all stations in the request.
+        # Stations are packed into groups which fit into one request for the whole period (first fit),
+        # stations which exceed the limit alone get a group on their own (and several windows)
+        hours = max((end_time - start_time).total_seconds()/3600, 1.0)
+        capacity = fill*limit/hours
+        groups = []
+        for station_id in sorted(station_ids, key=lambda s: -station_rates[s]):
+            for group in groups:
+                if group["rate"] + station_rates[station_id] <= capacity:
+                    group["stations"].append(station_id)
+                    group["rate"] += station_rates[station_id]
+                    break
+            else:
+                groups.append({"stations": [station_id], "rate": station_rates[station_id]})
+
+        chunks = []
+        for group in groups:
+            windows = self.plan_windows(start_time, end_time, group["rate"] if group["rate"] > 0 else None, limit, fill)
+            self.__log("Planned " + str(len(windows)) + " request(s) for " + ",".join(group["stations"]))
+            for inter_start, inter_end in windows:
+                chunks.extend(self.__fetch_window(",".join(group["stations"]), ",".join(params), 
+                    inter_start, inter_end, client_id, limit))
+
+        if len(chunks) == 0:
+            return {}
+        timeseries = self.concat(chunks)
+
+        # Splitting the combined response into the series per (station_id, param)
+        # NOTE: The sourceIds in the observations have format AA00000:0
+        sources = timeseries["sourceId"].astype(str).str.split(":").str[0]
+        meta_cols = [c for c in timeseries.columns if not any(p.lower() in c for p in params)]
+        data = {}
+        for station_id in station_ids:
+            station_timeseries = timeseries.loc[sources == station_id]
+            for param in params:
+                # NOTE: The Frost data can contain data for different "levels" for a parameter
+                cols_param = [c for c in timeseries.columns if param.lower() in c]
+                if len(cols_param) == 0:
+                    continue
+                ts = station_timeseries[meta_cols + cols_param].dropna(how="all", subset=cols_param)
+                if len(ts) > 0:
+                    data[(station_id, param)] = ts.reset_index(drop=True)
+
+        return data
+
+
+    def observation_rate(self, station_id, param, start_time=None, end_time=None,\
+        client_id='3cf0c17c-9209-4504-910c-176366ad78ba'):
+        """Estimates the number of observations per hour for station_id and param 
+        from the time resolutions of the available time series (all levels and time offsets).
+        Returns None if the metadata cannot be fetched"""
+        rates = self.observation_rates([station_id], [param], start_time, end_time, client_id=client_id)
+        if (station_id, param) not in rates:
+            return None
+        return rates[(station_id, param)]
 
-        # Fetching source data from frost for the given param 
-        url = "https://frost.met.no/sources/v0.jsonld"
 
-        payload = {"validtime":str(self.start_time.date())+"/"+str(self.end_time.date()),
-                        "elements":param}
+    def observation_rates(self, station_ids, params, start_time=None, end_time=None,\
+        client_id='3cf0c17c-9209-4504-910c-176366ad78ba'):
+        """Estimates the number of observations per hour for all combinations of station_ids and params 
+        (see observation_rate) with one metadata request.
+        Returns a dict with the rate per (station_id, param) - pairs without time series are missing"""
+
+        # using member variables if applicable
+        if start_time is None:
+            start_time = self.start_time
+        if end_time is None:
+            end_time = self.end_time
+
+        url_availability = self.frost_api_base + "/observations/availableTimeSeries/v0.jsonld"
+
+        payload_availability = {'sources': ",".join(station_ids), 'elements': ",".join(params),
+                    'referencetime': start_time.isoformat() + "/" + end_time.isoformat() + ""}
 
         try:
-            r = requests.get(url, params=payload, auth=(client_id,''))
+            r = self.http.get(url_availability, params=payload_availability, auth=(client_id,''))
             self.__log("Trying " + r.url)
             r.raise_for_status()
-        except requests.exceptions.HTTPError as err:
-            raise Exception(err)
+            elements = r.json()['data']
+        except (requests.exceptions.RequestException, ValueError, KeyError) as err:
+            self.__log(str(err))
+            return {}
+
+        rates = {}
+        for element in elements:
+            hours = self.__duration_hours(element.get("timeResolution", ""))
+            if hours is not None and hours > 0:
+                # NOTE: The sourceIds in observations/availableTimeseries have format AA00000:0 
+                key = (element["sourceId"].split(":")[0], element["elementId"])
+                rates[key] = rates.get(key, 0.0) + 1.0/hours
+        
+        return rates
 
-        data = r.json()['data']
 
-        # storing location information data frame
-        df = pd.DataFrame()
-        for element in data:
-            if "geometry" in element:
-                row = pd.DataFrame(element["geometry"])
-                row["station_id"] = element["id"]
-                df = df.append(row)
+    @staticmethod
+    def plan_windows(start_time, end_time, rate, limit=100000, fill=0.9):
+        """Splits [start_time, end_time] into consecutive windows 
+        that hold about fill*limit observations for the given rate (observations per hour).
+        Without a rate a single window is planned (and split on demand)"""
+        if rate is None:
+            return [(start_time, end_time)]
+
+        length = datetime.timedelta(hours=fill*limit/rate)
+        windows = []
+        inter_start = start_time
+        while inter_start < end_time:
+            inter_end = min(inter_start + length, end_time)
+            windows.append((inter_start, inter_end))
+            inter_start = inter_end
+        
+        if len(windows) == 0:
+            windows.append((start_time, end_time))
+        return windows
+
 
-        df = df.reset_index()
+    def __fetch_window(self, station_id, param, inter_start, inter_end, client_id, limit=100000):
+        """Fetches the observations in [inter_start, inter_end], 
+        if the window exceeds the observation limit of Frost it is split in halves.
+        Returns a list of data frames (empty if there are no observations or the request failed)"""
 
-        # Fetching double check from observations/availableTimeseries
-        url_availability = "https://frost.met.no/observations/availableTimeSeries/v0.jsonld"
+        # Fetching data from server
+        endpoint = self.frost_api_base + "/observations/v0.csv"
 
-        payload_availability = {'elements': param,
-                    'referencetime': self.start_time.isoformat() + "/" + self.end_time.isoformat() + ""}
+        payload = {'referencetime': inter_start.isoformat() + "Z/" + inter_end.isoformat() + "Z", 
+                    'sources': station_id, 'elements': param}
 
+        # NOTE: Network errors (also while reading the streamed body) fail the window only, not the whole request
         try:
-            r_availability = requests.get(url_availability, params=payload_availability, auth=(client_id,''))
-            self.__log("Trying " + r_availability.url)
+            df, truncated = self.__request_window(endpoint, payload, client_id, limit)
+        except requests.exceptions.RequestException as err:
+            self.__log(str(err))
+            self.failures.append((station_id, param, inter_start, inter_end, str(err)))
+            return []
+        if df is None and not truncated:
+            return []
+
+        if truncated and (inter_end - inter_start) > datetime.timedelta(hours=1):
+            self.__log("The request exceeds the observation limit and is split")
+            inter_middle = inter_start + (inter_end - inter_start)/2
+            return self.__fetch_window(station_id, param, inter_start, inter_middle, client_id, limit) \
+                + self.__fetch_window(station_id, param, inter_middle, inter_end, client_id, limit)
+
+        if df is None:
+            err = "The window of one hour exceeds the observation limit"
+            self.__log(err)
+            self.failures.append((station_id, param, inter_start, inter_end, err))
+            return []
+        return [df]
+
+
+    def __request_window(self, endpoint, payload, client_id, limit):
+        """Requests one window and returns the data frame (or None) and whether the window exceeds the limit"""
+        r = self.http.get(endpoint, params=payload, auth=(client_id,''), stream=True)
+        self.__log("Trying " + r.url)
+        try:
+            # NOTE: Frost rejects requests that exceed the limit with 413 or 412 (or the response is cut at the limit),
+            # but answers 412 (or 404) for windows without any time series as well
+            if r.status_code == 413 or (r.status_code == 412 and self.__exceeds_limit(r)):
+                return None, True
+            if r.status_code in [404, 412]:
+                self.__log("No observations in the window")
+                return None, False
             r.raise_for_status()
-        except requests.exceptions.HTTPError as err:
-            raise Exception(err)
 
-        data_availability = r_availability.json()['data']
+            # Storing in dataframe
+            df = self.read_csv(r)
+            df = df.reset_index()
+            return df, len(df) >= limit
+        finally:
+            r.close()
 
-        id_list = []
-        for element in data_availability:
-            dict_tmp = {}
-            # NOTE: The sourceIds in observations/availableTimeseries have format AA00000:0 
-            # and only the first part is comparable to the sourceIds from Sources/
-            dict_tmp.update({"id":element["sourceId"].split(":")[0]})
-            id_list.append(dict_tmp)
 
-        df_availability = pd.DataFrame(id_list)
+    @staticmethod
+    def __exceeds_limit(r):
+        """Whether the body of the 412 response r names the observation limit"""
+        reason = r.text.lower()
+        return "limit" in reason or "exceed" in reason or "maximum" in reason
+
+
+    @staticmethod
+    def read_csv(r, chunksize=50000):
+        """Parses the csv body of the (streamed) Frost response r chunk by chunk 
+        without holding the whole body as string.
+        The observations are read as float32, the times as UTC datetimes 
+        and the sources and levels as categories"""
+        # NOTE: The body is read through iter_content, which decodes the content (like gzip) for all urllib3 versions
+        stream = _ResponseStream(r)
+        try:
+            chunks = [FrostImporter.__types(chunk) for chunk in 
+                        pd.read_csv(io.BufferedReader(stream), chunksize=chunksize)]
+        except pd.errors.EmptyDataError:
+            if stream.nonblank:
+                raise Exception("The csv response has no header but a body: " + r.url)
+            return pd.DataFrame()
         
-        # Extracting only those stations where really time series are available
-        df = df.loc[df['station_id'].isin(df_availability["id"])]
+        return FrostImporter.concat(chunks)
+
+
+    @staticmethod
+    def __types(chunk):
+        """The observations as float32, the times as UTC datetimes and the sources and levels as categories"""
+        for name in chunk.columns:
+            if name == "referenceTime":
+                chunk[name] = pd.to_datetime(chunk[name], utc=True)
+            elif name == "sourceId" or "level" in name.lower():
+                chunk[name] = chunk[name].astype("category")
+            else:
+                chunk[name] = chunk[name].astype("float32")
+        return chunk
 
-        # Building data frame with coordinates and distances with respect to havvarsel_location
-        latlon_ref = (float(havvarsel_location["lat"][0]),float(havvarsel_location["lon"][0]))
 
-        df_dist = pd.DataFrame()
-        for i in range(int(len(df)/2)):
-            id  = df.iloc[2*i]["station_id"]
-            latlon = (df.iloc[2*i+1]["coordinates"],df.iloc[2*i]["coordinates"])
-            dist  = haversine(latlon_ref,latlon)
-            df_dist = df_dist.append({"station_id":id, "lat":latlon[0], "lon":latlon[1], "dist":dist}, ignore_index=True)
+    @staticmethod
+    def concat(chunks):
+        """Concatenates data frames from read_csv in one go 
+        (and keeps the categorical columns categorical even if the categories of the chunks differ)"""
+        df = pd.concat(chunks, ignore_index=True)
+        for name in chunks[0].columns:
+            if isinstance(chunks[0][name].dtype, pd.CategoricalDtype) and not isinstance(df[name].dtype, pd.CategoricalDtype):
+                df[name] = df[name].astype("category")
+        return df
+
+
+    @staticmethod
+    def __duration_hours(duration):
+        """Length of an ISO 8601 duration (like PT1H, PT10M, P1D) in hours"""
+        match = re.match(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$", duration)
+        if match is None:
+            return None
+        days, hours, minutes, seconds = [int(g) if g is not None else 0 for g in match.groups()]
+        return days*24 + hours + minutes/60 + seconds/3600
 
-        # Identify closest n stations 
-        df_ids = df_dist.nsmallest(n,"dist")
-        df_ids = df_ids.reset_index(drop=True)
+
+    def location_ids(self, havvarsel_location, n, param, client_id='3cf0c17c-9209-4504-910c-176366ad78ba'):
+        """Used in the full DataImporter....
+        Identifying the n closest station_ids in the Frost database around havvarsel_locations
+        where havvarsel_location is given as a dataframe with latlon coordinates"""
+
+
+        # Building data frame with coordinates and distances with respect to havvarsel_location
+        # and identify closest n stations (from the locally cached station catalog)
+        df_ids = self.catalog.nearest(float(havvarsel_location["lat"][0]), float(havvarsel_location["lon"][0]), n, 
+                    param, self.start_time, self.end_time, client_id)
 
         self.__log(df_ids.to_string())
         
@@ -219,9 +402,31 @@ class FrostImporter:
 
     
     def __log(self, msg):
-        print(msg)
-        with open("log.txt", 'a') as f:
-            f.write(msg + '\n')
+        Instrumentation.default().log(msg, "FrostImporter")
+
+class _ResponseStream(io.RawIOBase):
+    """Readable stream of the decoded body of the response r"""
+    def __init__(self, r, chunk_size=65536):
+        self.__chunks = r.iter_content(chunk_size=chunk_size)
+        self.__buffer = b""
+        # whether the body contains anything but whitespace
+        self.nonblank = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.__buffer) == 0:
+            self.__buffer = next(self.__chunks, None)
+            if self.__buffer is None:
+                self.__buffer = b""
+                return 0
+            self.nonblank = self.nonblank or len(self.__buffer.strip()) > 0
+        n = min(len(b), len(self.__buffer))
+        b[:n] = self.__buffer[:n]
+        self.__buffer = self.__buffer[n:]
+        return n
+
 
 if __name__ == "__main__":
 
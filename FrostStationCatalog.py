@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""Catalog of the Frost stations (frost.met.no) that have observations of an element
+
+The station metadata (sources/v0.jsonld) and the available time series (observations/availableTimeSeries/v0.jsonld)
+are fetched once per element and validity window and stored locally.
+Nearest station queries are then answered with a vectorized haversine distance without any download.
+
+Usage (see FrostImporter.location_ids):
+'catalog = FrostStationCatalog.FrostStationCatalog()'
+'df_ids = catalog.nearest(lats, lons, n, "air_temperature", start_time, end_time, client_id)'
+
+Test:
+'python3 FrostStationCatalog.py -lat 59.9 -lon 10.7 -n 5 -param air_temperature -S 2021-06-01T00:00 -E 2021-06-30T23:59'
+
+"""
+
+import argparse
+import sys
+import os
+import json
+import time
+import datetime
+import hashlib
+import threading
+from traceback import format_exc
+import pandas as pd
+import numpy as np
+
+import HttpClient
+import IOArchive
+import ThreddsUtils
+
+
+# mean earth radius in km (as in the haversine package)
+EARTH_RADIUS = 6371.0088
+
+
+class FrostStationCatalog:
+    def __init__(self, frost_api_base="https://frost.met.no", http=None,
+            cache_dir=os.path.join("cache", "frost_stations"), ttl=7*24*3600):
+        """ Initialisation of FrostStationCatalog Class
+        frost_api_base: url of the Frost API (can point to a local mock server as well)
+        http: HttpClient for the requests (or None for the shared client)
+        cache_dir: directory where the station lists are stored
+        ttl: time in seconds after which a station list is fetched again
+        """
+        self.frost_api_base = frost_api_base
+        self.http = http if http is not None else HttpClient.default()
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # station lists of this session
+        self.__stations = {}
+        self.__lock = threading.Lock()
+
+
+    def stations(self, param, start_time, end_time, client_id='3cf0c17c-9209-4504-910c-176366ad78ba'):
+        """Returns the stations (station_id, lat, lon) with available time series of param
+        between start_time and end_time"""
+        validtime = str(start_time.date()) + "/" + str(end_time.date())
+        referencetime = start_time.isoformat() + "/" + end_time.isoformat()
+        key = hashlib.sha1((self.frost_api_base + "|" + param + "|" + referencetime).encode("utf-8")).hexdigest()
+
+        with self.__lock:
+            if key in self.__stations:
+                return self.__stations[key]
+
+        path = os.path.join(self.cache_dir, key + ".json")
+        df = None
+        # NOTE: With an active IOArchive the stations are always requested (and recorded or replayed)
+        if IOArchive.default() is None:
+            try:
+                with open(path) as f:
+                    catalog = json.load(f)
+                if time.time() - catalog["fetched"] < self.ttl:
+                    df = pd.DataFrame(catalog["stations"], columns=["station_id", "lat", "lon"])
+            except (OSError, ValueError, KeyError):
+                pass
+
+        if df is None:
+            df = self.__fetch(param, validtime, referencetime, client_id)
+            with ThreddsUtils.atomic_path(path) as tmp_path:
+                with open(tmp_path, "w") as f:
+                    json.dump({"element": param, "validtime": validtime, "referencetime": referencetime,
+                        "fetched": time.time(), "stations": df.values.tolist()}, f)
+
+        df["lat"] = df["lat"].astype("float64")
+        df["lon"] = df["lon"].astype("float64")
+
+        with self.__lock:
+            self.__stations[key] = df
+
+        return df
+
+
+    def nearest(self, lats, lons, n, param, start_time, end_time, client_id='3cf0c17c-9209-4504-910c-176366ad78ba'):
+        """Identifying the n closest stations (with available time series of param) around each location.
+        For a single location a data frame (station_id, lat, lon, dist) sorted by distance is returned,
+        for arrays of locations a list of those"""
+        df = self.stations(param, start_time, end_time, client_id)
+
+        single = np.ndim(lats) == 0
+        dist = self.haversine(np.atleast_1d(lats), np.atleast_1d(lons), df["lat"].values, df["lon"].values)
+
+        n = min(n, len(df))
+        if n < len(df):
+            candidates = np.argpartition(dist, n-1, axis=1)[:, :n]
+        else:
+            candidates = np.tile(np.arange(len(df)), (dist.shape[0], 1))
+
+        results = []
+        for i in range(dist.shape[0]):
+            # NOTE: stable sort such that ties are ordered as in the Frost source list
+            idx = candidates[i][np.argsort(dist[i, candidates[i]], kind="stable")]
+            df_ids = df.iloc[idx].reset_index(drop=True)
+            df_ids["dist"] = dist[i, idx]
+            results.append(df_ids)
+
+        if single:
+            return results[0]
+        return results
+
+
+    @staticmethod
+    def haversine(lats1, lons1, lats2, lons2):
+        """Great circle distances in km between all locations (lats1, lons1) and all locations (lats2, lons2)
+        as matrix of shape (len(lats1), len(lats2))"""
+        lat1 = np.radians(np.asarray(lats1, dtype="float64"))[:, None]
+        lon1 = np.radians(np.asarray(lons1, dtype="float64"))[:, None]
+        lat2 = np.radians(np.asarray(lats2, dtype="float64"))[None, :]
+        lon2 = np.radians(np.asarray(lons2, dtype="float64"))[None, :]
+
+        d = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+        return 2*EARTH_RADIUS*np.arcsin(np.sqrt(d))
+
+
+    def __fetch(self, param, validtime, referencetime, client_id):
+        # Fetching source data from frost for the given param
+        url = self.frost_api_base + "/sources/v0.jsonld"
+        payload = {"validtime": validtime, "elements": param}
+
+        r = self.http.get(url, params=payload, auth=(client_id,''))
+        r.raise_for_status()
+
+        ids, lats, lons = [], [], []
+        for element in r.json()['data']:
+            if "geometry" in element:
+                # NOTE: The coordinates are given as [lon, lat]
+                lon, lat = element["geometry"]["coordinates"][:2]
+                ids.append(element["id"])
+                lats.append(lat)
+                lons.append(lon)
+
+        # Fetching double check from observations/availableTimeseries
+        url_availability = self.frost_api_base + "/observations/availableTimeSeries/v0.jsonld"
+        payload_availability = {'elements': param, 'referencetime': referencetime}
+
+        r_availability = self.http.get(url_availability, params=payload_availability, auth=(client_id,''))
+        if r_availability.status_code == 404:
+            # no time series at all
+            available = set()
+        else:
+            r_availability.raise_for_status()
+            # NOTE: The sourceIds in observations/availableTimeseries have format AA00000:0
+            # and only the first part is comparable to the sourceIds from Sources/
+            available = set(element["sourceId"].split(":")[0] for element in r_availability.json()['data'])
+
+        df = pd.DataFrame({"station_id": ids, "lat": lats, "lon": lons})
+
+        # Extracting only those stations where really time series are available
+        return df.loc[df["station_id"].isin(available)].reset_index(drop=True)
+
+
+    @staticmethod
+    def __parse_args():
+        parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument(
+            '-lat', required=True, type=float, help='latitude of the location')
+        parser.add_argument(
+            '-lon', required=True, type=float, help='longitude of the location')
+        parser.add_argument(
+            '-n', default=5, type=int, help='number of stations')
+        parser.add_argument(
+            '-param', required=True, help='element (like air_temperature)')
+        parser.add_argument(
+            '-S', '--start-time', required=True,
+            help='start time in ISO format (YYYY-MM-DDTHH:MM) UTC')
+        parser.add_argument(
+            '-E', '--end-time', required=True,
+            help='end time in ISO format (YYYY-MM-DDTHH:MM) UTC')
+        res = parser.parse_args(sys.argv[1:])
+        return res.lat, res.lon, res.n, res.param, res.start_time, res.end_time
+
+
+    @staticmethod
+    def main():
+        lat, lon, n, param, start_time, end_time = FrostStationCatalog.__parse_args()
+        start_time = datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
+        end_time = datetime.datetime.strptime(end_time, "%Y-%m-%dT%H:%M")
+        print(FrostStationCatalog().nearest(lat, lon, n, param, start_time, end_time).to_string())
+
+
+if __name__ == "__main__":
+
+    try:
+        FrostStationCatalog.main()
+    except SystemExit as e:
+        if e.code != 0:
+            print('SystemExit(code={}): {}'.format(e.code, format_exc()), file=sys.stderr)
+            sys.exit(e.code)
+    except: # pylint: disable=bare-except
+        print('error: {}'.format(format_exc()), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""Spatial index for the grid point lookup in the THREDDS models (NorKyst800 and post-processed forecasts)
+
+The static fields (projected coordinates, lat, lon and depth) of the relevant grid cells
+are fetched once from a THREDDS file and stored locally as a numpy file (which is memory-mapped when loaded).
+Nearest grid cell queries are then answered with a KD-tree without any download.
+
+Usage:
+'index = GridIndex.load("norkyst800", filename)'
+'ys, xs = index.nearest(lons, lats)'
+
+"""
+
+import os
+import json
+import hashlib
+import netCDF4
+import numpy as np
+import pyproj as proj
+from scipy.spatial import cKDTree
+
+import Instrumentation
+import IOArchive
+import ThreddsUtils
+
+
+class GridIndex:
+    def __init__(self, name, proj4, shape, cells):
+        """ Initialisation of GridIndex Class
+        Use GridIndex.load(...) to get an instance from the local storage (or to build it)
+        """
+        self.name = name
+        self.proj4 = proj4
+        self.shape = tuple(shape)
+        # structured array with one entry per indexed grid cell
+        self.cells = cells
+
+        self.__proj = proj.Proj(str(proj4))
+        self.__tree = None
+
+
+    @classmethod
+    def load(cls, name, filename, wet_only=True, cache_dir=os.path.join("cache", "grid_index"), source=None):
+        """Returns the index `name` from cache_dir,
+        if it does not exist yet it is built from the netCDF file `filename` and stored.
+        source: location of all files sharing the grid (default: the directory of filename)"""
+        # NOTE: The stored index is identified by the source of the grid as well,
+        # such that a grid from another source (e.g. local copies or another model version) is not used silently
+        if source is None:
+            source = os.path.dirname(str(filename))
+        source = str(source) + " wet_only=" + str(bool(wet_only))
+        path = os.path.join(cache_dir, name + "_" + hashlib.sha1(source.encode("utf-8")).hexdigest()[:16])
+        # NOTE: With an active IOArchive the index is always built from the (recorded) static fields
+        archive = IOArchive.default()
+        if archive is None and os.path.exists(path + ".npy") and os.path.exists(path + ".json"):
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            if meta.get("source") == source:
+                cells = np.load(path + ".npy", mmap_mode="r")
+                if len(cells) == meta.get("cells"):
+                    return cls(name, meta["proj4"], meta["shape"], cells)
+            cls.__log("The stored grid index " + path + " does not match " + source + ", it is rebuilt")
+
+        index = cls.build(name, filename, wet_only)
+        if archive is None:
+            index.save(path, source)
+        return index
+
+
+    @classmethod
+    def build(cls, name, filename, wet_only=True):
+        """Fetches the static fields from `filename` and constructs the index
+        (with wet_only only cells that are not land in the depth field "h" are indexed)"""
+        archive = IOArchive.default()
+        if archive is None:
+            fields = cls.static_fields(filename)
+        else:
+            fields = archive.arrays(filename, "static_fields", (), lambda: cls.static_fields(filename))
+        proj4, lats, lons, h = str(fields["proj4"]), fields["lat"], fields["lon"], fields["h"]
+
+        p = proj.Proj(proj4)
+        xps, yps = p(lons, lats)
+
+        if wet_only:
+            land_value = h.min()
+            mask = (h != land_value)
+        else:
+            mask = np.ones(lats.shape, dtype=bool)
+        ys, xs = np.nonzero(mask)
+
+        cells = np.empty(len(ys), dtype=[("y", "i4"), ("x", "i4"), ("xp", "f8"), ("yp", "f8"),
+                                          ("lat", "f8"), ("lon", "f8"), ("h", "f8")])
+        cells["y"], cells["x"] = ys, xs
+        cells["xp"], cells["yp"] = xps[mask], yps[mask]
+        cells["lat"], cells["lon"] = lats[mask], lons[mask]
+        cells["h"] = h[mask]
+
+        return cls(name, proj4, lats.shape, cells)
+
+
+    @staticmethod
+    def static_fields(filename):
+        """Fetches the projection (proj4 string), lat, lon and depth h (NaN if the file has no depth) from `filename`"""
+        # NOTE: The netCDF-C library is not thread-safe (see ThreddsUtils.NETCDF_LOCK)
+        with ThreddsUtils.NETCDF_LOCK:
+            nc = netCDF4.Dataset(filename)
+            Instrumentation.default().count("netcdf.opens")
+
+            # handle projection
+            for var in ['polar_stereographic','projection_stere','grid_mapping','projection_lcc']:
+                if var in nc.variables.keys():
+                    try:
+                        proj4 = nc.variables[var].proj4
+                    except:
+                        proj4 = nc.variables[var].proj4string
+
+            for var in ['latitude','lat']:
+                if var in nc.variables.keys():
+                    lats = np.array(nc.variables[var][:])
+            for var in ['longitude','lon']:
+                if var in nc.variables.keys():
+                    lons = np.array(nc.variables[var][:])
+
+            if "h" in nc.variables.keys():
+                h = np.array(nc["h"])
+            else:
+                h = np.full(lats.shape, np.nan)
+            nc.close()
+
+        return {"proj4": np.array(str(proj4)), "lat": lats, "lon": lons, "h": h}
+
+
+    def save(self, path, source):
+        """Stores the index as path.npy and path.json (see load)"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # NOTE: Both files are written to temporary files and moved into place (the .npy file first),
+        # such that a concurrent load never sees a partially written index
+        with ThreddsUtils.atomic_path(path + ".json") as json_path, ThreddsUtils.atomic_path(path + ".npy") as npy_path:
+            with open(npy_path, "wb") as f:
+                np.save(f, self.cells)
+            with open(json_path, "w") as f:
+                json.dump({"source": source, "proj4": str(self.proj4), "shape": list(self.shape),
+                           "cells": len(self.cells)}, f)
+
+
+    @staticmethod
+    def __log(msg):
+        Instrumentation.default().log(msg, "GridIndex")
+
+
+    def query(self, lons, lats):
+        """Returns the positions in self.cells of the nearest indexed cells to the given coordinates"""
+        if self.__tree is None:
+            self.__tree = cKDTree(np.column_stack([self.cells["xp"], self.cells["yp"]]))
+        xp, yp = self.__proj(np.atleast_1d(np.asarray(lons, dtype=float)), np.atleast_1d(np.asarray(lats, dtype=float)))
+        _, i = self.__tree.query(np.column_stack([xp, yp]))
+        return i
+
+
+    def nearest(self, lons, lats):
+        """Returns the grid indices (ys, xs) of the nearest indexed cells to the given coordinates"""
+        i = self.query(lons, lats)
+        return self.cells["y"][i], self.cells["x"][i]
@@ -16,16 +16,28 @@ import datetime
 import requests
 from traceback import format_exc
 import pandas as pd
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import HttpClient
+import Instrumentation
 
 
 class HavvarselFrostImporter:
 
-    def __init__(self, start_time=None, end_time=None):
+    def __init__(self, start_time=None, end_time=None, http=None):
         """ Initialisation of DataImporter Class
         If nothing is specified as argument, command line arguments are expected.
         Otherwise an empty instance of the class is created
+        http: HttpClient for the requests (or None for the shared client)
         """
 
+        self.http = http if http is not None else HttpClient.default()
+
         # For command line calls the class reads the parameters from argsPars
         if start_time is None:
             station_id, start_time, end_time = self.__parse_args()
@@ -57,6 +69,44 @@ class HavvarselFrostImporter:
         if end_time is None:
             end_time = self.end_time
 
+        tseries = self.__request(station_id, param, frost_api_base, start_time, end_time)
+
+        # NOTE: Assumes that the response contains only one timeseries
+        df_location, df = self.__parse_tseries(tseries[0])
+        self.__log(df_location.to_string())
+
+        return(df_location, df)
+
+
+    def data_multi(self, station_ids, param="temperature", frost_api_base="https://havvarsel-frost.met.no", \
+        start_time=None, end_time=None, batch=50):
+        """Fetch data for many buoys from Havvarsel Frost server 
+        with one request per `batch` buoys.
+        Returns a dict with (location, hourly timeseries) per buoyid as in data()
+        (buoys without any timeseries are missing)"""
+
+        # using member variables if applicable
+        if start_time is None:
+            start_time = self.start_time
+        if end_time is None:
+            end_time = self.end_time
+
+        station_ids = list(dict.fromkeys(str(station_id) for station_id in station_ids))
+
+        data = {}
+        for b in range(0, len(station_ids), batch):
+            tseries = self.__request(",".join(station_ids[b:b+batch]), param, frost_api_base, start_time, end_time)
+            for ts in tseries:
+                df_location, df = self.__parse_tseries(ts)
+                data[str(df_location["buoyid"][0])] = (df_location, df)
+
+        return data
+
+
+    def __request(self, station_id, param, frost_api_base, start_time, end_time):
+        """Requests the observations of param for the buoy(s) station_id (comma separated) 
+        and returns the list of timeseries in the response"""
+
         # Fetching the data from the server
         endpoint = frost_api_base + "/api/v1/obs/badevann/get"
 
@@ -65,40 +115,41 @@ class HavvarselFrostImporter:
         payload_str = "&".join("%s=%s" % (k,v) for k,v in payload.items())
 
         try:
-            r = requests.get(endpoint, params=payload_str)
+            r = self.http.get(endpoint, params=payload_str)
             print("- " + time.strftime("%H:%M:%S", time.gmtime()) + " -")
             self.__log("Trying " + r.url)
             r.raise_for_status()
         except requests.exceptions.HTTPError as err:
             raise Exception(err)
 
+        # NOTE: The response is decoded only once (with orjson if available)
+        if orjson is not None:
+            response = orjson.loads(r.content)
+        else:
+            response = json.loads(r.content)
+
+        return response["data"]["tseries"]
+
+
+    @staticmethod
+    def __parse_tseries(tseries):
+        """Converts one timeseries of the Frost response 
+        into the location and the hourly observations (water_temp)"""
+
         # extract meta information from the Frost response
-        # NOTE: Assumes that the response contains only one timeseries
-        header = r.json()["data"]["tseries"][0]["header"]
+        header = tseries["header"]
         # Cast to data frame
         header_list = [header["id"]["buoyid"],header["id"]["parameter"]]
         header_list.extend([header["extra"]["name"], header["extra"]["pos"]["lon"], header["extra"]["pos"]["lat"]])
         df_location = pd.DataFrame([header_list], columns=["buoyid","parameter","name","lon","lat"])
-        self.__log(df_location.to_string())
 
         # extract the actual observations from the Frost response
-        # NOTE: Assumes that the response contains only one timeseries
-        observations = r.json()["data"]["tseries"][0]["observations"]
-        
-        # massage data for pandas
-        rows = []
-        for data in observations:
-            row = {}
-            row['time'] = data['time']
-            row[param] = data['body']['value']
-            rows.append(row)
+        observations = tseries["observations"]
         
-        # make DataFrame (and convert from strings to datetime and numeric value)
-        df = pd.DataFrame(rows)
-        df['time'] =  pd.to_datetime(df['time'])
-        df[param] = pd.to_numeric(df[param])
-        df.columns = ['time', "water_temp"]
-        df.set_index('time')
+        # make DataFrame (and convert from strings to datetime and numeric value in one go)
+        times = pd.to_datetime(np.array([data['time'] for data in observations], dtype=object), utc=True)
+        values = pd.to_numeric(np.array([data['body']['value'] for data in observations], dtype=object))
+        df = pd.DataFrame({"time": times, "water_temp": values})
 
         # NOTE: some observations are 1min delayed. 
         # To ensure agreement with hourly observations from Frost
@@ -125,9 +176,7 @@ class HavvarselFrostImporter:
 
     
     def __log(self, msg):
-        print(msg)
-        with open("log.txt", 'a') as f:
-            f.write(msg + '\n')
+        Instrumentation.default().log(msg, "HavvarselFrostImporter")
 
 
 if __name__ == "__main__":
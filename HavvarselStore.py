@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+"""Local store of the Havvarsel Frost observations for incremental updates
+
+Per buoy the hourly series (see HavvarselFrostImporter) is stored in the store directory
+together with the covered time intervals and a high-water mark (the time of the last stored observation) 
+in its own state file, such that several processes can sync different buoys into the same store.
+A sync only fetches the parts of the requested window that are not covered yet
+- after the most recent interval from the high-water mark on with an overlap of some hours to catch late corrections -
+and merges them into the stored series (fetched values replace stored values).
+
+Usage (see DataImporter):
+'store = HavvarselStore.HavvarselStore("cache/havvarsel")'
+'data = store.sync(["5","100"], datetime.datetime(2019,1,1))'
+'location, timeseries = data["5"]'
+
+Test:
+'python3 HavvarselStore.py -ids 5,100 -S 2019-01-01T00:00'
+
+"""
+
+import argparse
+import sys
+import os
+import json
+import datetime
+from traceback import format_exc
+import pandas as pd
+
+import HavvarselFrostImporter
+import ThreddsUtils
+
+
+class HavvarselStore:
+    def __init__(self, store_dir=os.path.join("cache", "havvarsel"), overlap=datetime.timedelta(hours=6), importer=None,
+            frost_api_base="https://havvarsel-frost.met.no"):
+        """ Initialisation of HavvarselStore Class
+        store_dir: directory where the series and the state are stored
+        overlap: time before the high-water mark that is fetched again
+        importer: HavvarselFrostImporter for the requests (or None for a new one)
+        frost_api_base: base url of the Havvarsel Frost API
+        """
+        self.store_dir = store_dir
+        self.overlap = overlap
+        self.frost_api_base = frost_api_base
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        self.importer = importer
+        if self.importer is None:
+            self.importer = HavvarselFrostImporter.HavvarselFrostImporter(start_time=datetime.datetime.utcnow(),
+                                end_time=datetime.datetime.utcnow())
+
+
+    def high_water_mark(self, station_id):
+        """Time of the last stored observation of the buoy (or None)"""
+        state = self.__state(station_id)
+        if state is None:
+            return None
+        return pd.Timestamp(state["high_water_mark"])
+
+
+    def load(self, station_id):
+        """Returns the stored (location, hourly timeseries) of the buoy (or None)"""
+        station_id = str(station_id)
+        state = self.__state(station_id)
+        if state is None or not os.path.exists(self.__path(station_id)):
+            return None
+
+        df_location = pd.DataFrame([state["location"]], columns=["buoyid","parameter","name","lon","lat"])
+        df = pd.read_csv(self.__path(station_id), index_col="time")
+        df.index = pd.to_datetime(df.index, utc=True)
+
+        return df_location, df
+
+
+    def sync(self, station_ids, first_time, end_time=None):
+        """Brings the stored series of the buoys up to date within [first_time, end_time] (default end: now).
+        Only the parts of the window that are not covered by the store yet are fetched (see missing).
+        Returns a dict with the updated (location, hourly timeseries within [first_time, end_time]) per buoyid"""
+        if end_time is None:
+            end_time = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+        # NOTE: Buoys with the same missing range are fetched together
+        fetches = {}
+        station_ids = list(dict.fromkeys(str(station_id) for station_id in station_ids))
+        for station_id in station_ids:
+            for start, end in self.missing(station_id, first_time, end_time):
+                fetches.setdefault((start, end), []).append(station_id)
+
+        data = {}
+        for (start, end), group in sorted(fetches.items()):
+            fetched = self.importer.data_multi(group, frost_api_base=self.frost_api_base, 
+                            start_time=_naive(start), end_time=_naive(end))
+            for station_id in group:
+                if station_id not in fetched:
+                    continue
+                df_location, df = fetched[station_id]
+                stored = self.load(station_id)
+                if stored is not None:
+                    # fetched values replace the stored ones in the overlap
+                    df = df.combine_first(stored[1])
+                self.__save(station_id, df_location, df, (start, end))
+                data[station_id] = (df_location, df)
+
+        for station_id in station_ids:
+            if station_id not in data:
+                stored = self.load(station_id)
+                if stored is not None:
+                    data[station_id] = stored
+
+        # NOTE: The store keeps the whole history, only the requested window is returned
+        window = slice(ThreddsUtils.utc(first_time), ThreddsUtils.utc(end_time))
+        return {station_id: (df_location, df.loc[window]) for station_id, (df_location, df) in data.items()}
+
+
+    def missing(self, station_id, first_time, end_time):
+        """Time ranges [(start, end)] within [first_time, end_time] that are not covered by the store.
+        The range after the most recent interval starts at its high-water mark minus the overlap"""
+        first_time, end_time = ThreddsUtils.utc(first_time), ThreddsUtils.utc(end_time)
+        intervals = self.intervals(station_id)
+        if len(intervals) == 0:
+            return [(first_time, end_time)]
+        hwm = self.high_water_mark(station_id)
+
+        ranges = []
+        t = first_time
+        for i, (start, end) in enumerate(intervals):
+            if i == len(intervals) - 1:
+                # NOTE: Observations after the high-water mark may still come in (or be corrected)
+                end = max(start, min(end, hwm) - self.overlap)
+            if end < t:
+                continue
+            if start > t:
+                ranges.append((t, min(start, end_time)))
+            t = end
+            if t >= end_time:
+                break
+        if t < end_time:
+            ranges.append((t, end_time))
+        return [(start, end) for start, end in ranges if start < end]
+
+
+    def intervals(self, station_id):
+        """Sorted and disjoint time intervals [(start, end)] that are covered by the store"""
+        state = self.__state(station_id)
+        if state is None:
+            return []
+        # NOTE: Older states only have the first time and the high-water mark
+        intervals = state.get("intervals", [[state["first_time"], state["high_water_mark"]]])
+        return [(ThreddsUtils.utc(start), ThreddsUtils.utc(end)) for start, end in intervals]
+
+
+    def __save(self, station_id, df_location, df, interval):
+        observed = df["water_temp"].dropna()
+        if len(observed) == 0:
+            return
+
+        intervals = []
+        for start, end in sorted(self.intervals(station_id) + [interval]):
+            if len(intervals) > 0 and start <= intervals[-1][1]:
+                intervals[-1] = (intervals[-1][0], max(intervals[-1][1], end))
+            else:
+                intervals.append((start, end))
+
+        # NOTE: Writing to temporary files first such that
+        # an interrupted sync never leaves a partially written series or state
+        # (the state is written after the series, such that it never points beyond the stored series)
+        with ThreddsUtils.atomic_path(self.__path(station_id)) as tmp_path:
+            df.to_csv(tmp_path, index_label="time")
+
+        state = {"first_time": df.index[0].isoformat(),
+                 "high_water_mark": observed.index[-1].isoformat(),
+                 "intervals": [[start.isoformat(), end.isoformat()] for start, end in intervals],
+                 "location": [str(v) for v in df_location.iloc[0].values]}
+        with ThreddsUtils.atomic_path(self.__state_path(station_id)) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, indent=1)
+
+
+    def __state(self, station_id):
+        """State of the buoy (or None if nothing is stored)"""
+        try:
+            with open(self.__state_path(station_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def __state_path(self, station_id):
+        return os.path.join(self.store_dir, "state_" + str(station_id) + ".json")
+
+
+    def __path(self, station_id):
+        return os.path.join(self.store_dir, "buoy_" + str(station_id) + ".csv")
+
+
+    @staticmethod
+    def __parse_args():
+        parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument(
+            '-ids', required=True,
+            help='comma separated buoy ids')
+        parser.add_argument(
+            '-S', '--start-time', required=True,
+            help='start time in ISO format (YYYY-MM-DDTHH:MM) UTC for buoys that are not stored yet')
+        parser.add_argument(
+            '-store', dest='store_dir', default=os.path.join("cache", "havvarsel"),
+            help='directory of the store')
+        res = parser.parse_args(sys.argv[1:])
+        return res.ids.split(","), res.start_time, res.store_dir
+
+
+    @staticmethod
+    def main():
+        station_ids, start_time, store_dir = HavvarselStore.__parse_args()
+        start_time = datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
+        data = HavvarselStore(store_dir).sync(station_ids, start_time)
+        for station_id, (_, df) in data.items():
+            print(station_id + ": " + str(df["water_temp"].count()) + " observations until " + str(df.index[-1]))
+
+
+
+def _naive(t):
+    """UTC time without timezone (as expected by HavvarselFrostImporter)"""
+    return t.tz_convert("UTC").tz_localize(None).to_pydatetime()
+
+
+if __name__ == "__main__":
+
+    try:
+        HavvarselStore.main()
+    except SystemExit as e:
+        if e.code != 0:
+            print('SystemExit(code={}): {}'.format(e.code, format_exc()), file=sys.stderr)
+            sys.exit(e.code)
+    except: # pylint: disable=bare-except
+        print('error: {}'.format(format_exc()), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
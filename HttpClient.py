@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""Shared HTTP client for the importers (FrostImporter, HavvarselFrostImporter, ThreddsManifest)
+
+- Keep-alive connection pooling (one requests.Session for all requests)
+- Retries with exponential backoff on connection errors and transient HTTP errors (429, 5xx)
+- Limit for concurrent requests per host
+- Counters for the number of requests, bytes and time per host
+- Recording and replay of the responses (if an IOArchive is active)
+
+Usage:
+'r = HttpClient.default().get(url, params=payload, auth=(client_id,""))'
+'print(HttpClient.default().summary())'
+'snapshot = HttpClient.default().snapshot()' ... 'print(HttpClient.default().summary(since=snapshot))'
+
+"""
+
+import time
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import Instrumentation
+import IOArchive
+
+
+class HttpClient:
+    def __init__(self, retries=5, backoff=0.5, timeout=(10, 300), max_per_host=4, pool_size=16):
+        """ Initialisation of HttpClient Class
+        retries: number of retries for connection errors and transient HTTP errors
+        backoff: backoff factor in seconds (waiting backoff*2^(retry-1) between retries)
+        timeout: (connect, read) timeout in seconds
+        max_per_host: maximal number of concurrent requests per host
+        pool_size: number of kept-alive connections per host
+        """
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                    status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # counters per host: requests, errors, bytes, seconds
+        self.stats = {}
+
+        self.__lock = threading.Lock()
+        self.__semaphores = {}
+
+
+    def get(self, url, params=None, auth=None, stream=False, **kwargs):
+        """GET request through the shared session (same arguments as requests.get)"""
+        archive = IOArchive.default()
+        if archive is not None:
+            return archive.response(url, params, lambda: self.__get(url, params, auth, stream, **kwargs))
+        return self.__get(url, params, auth, stream, **kwargs)
+
+
+    def __get(self, url, params, auth, stream, **kwargs):
+        host = urlparse(url).netloc
+        with self.__lock:
+            if host not in self.__semaphores:
+                self.__semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+                self.stats[host] = {"requests": 0, "errors": 0, "bytes": 0, "seconds": 0.0}
+            semaphore = self.__semaphores[host]
+
+        kwargs.setdefault("timeout", self.timeout)
+        with semaphore:
+            tic = time.time()
+            try:
+                r = self.session.get(url, params=params, auth=auth, stream=stream, **kwargs)
+            except requests.exceptions.RequestException:
+                with self.__lock:
+                    self.stats[host]["errors"] += 1
+                Instrumentation.default().count("http.errors")
+                raise
+            toc = time.time()
+
+        # NOTE: For streamed responses the body is not read yet, the announced length is counted
+        if stream:
+            size = int(r.headers.get("Content-Length", 0))
+        else:
+            size = len(r.content)
+
+        with self.__lock:
+            self.stats[host]["requests"] += 1
+            self.stats[host]["bytes"] += size
+            self.stats[host]["seconds"] += toc - tic
+            if r.status_code >= 400:
+                self.stats[host]["errors"] += 1
+
+        instrumentation = Instrumentation.default()
+        instrumentation.count("http.requests")
+        instrumentation.count("http.bytes", size)
+        if r.status_code >= 400:
+            instrumentation.count("http.errors")
+
+        return r
+
+
+    def snapshot(self):
+        """Copy of the current counters per host"""
+        with self.__lock:
+            return {host: dict(stats) for host, stats in self.stats.items()}
+
+
+    def stats_since(self, since=None):
+        """Counters per host after the snapshot since (all counters if since is None)"""
+        current = self.snapshot()
+        if since is None:
+            return current
+        stats = {}
+        for host, counters in current.items():
+            before = since.get(host, {})
+            counters = {name: value - before.get(name, 0) for name, value in counters.items()}
+            if counters["requests"] > 0 or counters["errors"] > 0:
+                stats[host] = counters
+        return stats
+
+
+    def summary(self, since=None):
+        lines = []
+        for host, stats in self.stats_since(since).items():
+            lines.append(host + ": " + str(stats["requests"]) + " requests, " + str(stats["errors"]) + " errors, "
+                + str(stats["bytes"]) + " bytes, " + "{:.1f}".format(stats["seconds"]) + " s")
+        return "\n".join(lines)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+def default():
+    """The HttpClient shared by all importers"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = HttpClient()
+        return _default
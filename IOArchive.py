@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""Record and replay of the remote I/O of the importers
+
+In record mode every HTTP response (see HttpClient) and every read from a netCDF file
+(slices, times, dimensions and static fields, see ThreddsUtils and GridIndex) is stored in a local archive directory.
+In replay mode they are served from the archive without any network access,
+such that a station can be rebuilt offline (and the processing can be profiled without network noise).
+
+Every entry is identified by its request (the full url or the file, variable and index)
+and stored compressed in its own file, such that several processes can record into the same archive.
+Requests that are not in the archive fail in replay mode.
+While an archive is active the local caches with an expiry (ThreddsManifest, FrostStationCatalog)
+and the stored grid indices (GridIndex) are bypassed, such that everything is recorded and replayed.
+
+Usage:
+'IOArchive.configure("archive/station_5", "record")'
+'python DataImporter.py -id 5 -S 2021-06-01T00:00 -E 2021-06-30T23:59 -record archive/station_5'
+'python DataImporter.py -id 5 -S 2021-06-01T00:00 -E 2021-06-30T23:59 -replay archive/station_5'
+
+"""
+
+import io
+import os
+import gzip
+import json
+import hashlib
+import threading
+import numpy as np
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import Instrumentation
+import ThreddsCache
+import ThreddsUtils
+
+
+MODES = ["record", "replay"]
+
+
+class IOArchive:
+    def __init__(self, directory, mode="replay"):
+        """ Initialisation of IOArchive Class
+        directory: location of the archive
+        mode: "record" (fetch and store) or "replay" (serve from the archive only)
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown archive mode " + str(mode) + " (use one of " + ", ".join(MODES) + ")")
+        if mode == "replay" and not os.path.isdir(directory):
+            raise Exception("The archive " + directory + " does not exist")
+
+        self.directory = directory
+        self.mode = mode
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.recorded = 0
+        self.replayed = 0
+
+        self.__lock = threading.Lock()
+
+
+    def response(self, url, params, fetch):
+        """Returns the response of the GET request (url with params),
+        if recording it is fetched by fetch() and stored"""
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        path = self.__path(hashlib.sha1(("GET|" + full_url).encode("utf-8")).hexdigest(), ".http.gz")
+
+        if self.mode == "replay":
+            try:
+                with gzip.open(path, "rb") as f:
+                    header, body = f.read().split(b"\n", 1)
+            except OSError:
+                raise Exception("Not in the archive " + self.directory + ": GET " + full_url)
+            self.__count("replayed")
+            return self.__build(json.loads(header.decode("utf-8")), body)
+
+        # NOTE: The body is read completely (also for streamed requests)
+        # and the caller gets a response that is built from the stored body
+        r = fetch()
+        body = r.content
+        r.close()
+        # NOTE: Only the url (without the authentication) and some headers are stored
+        meta = {"url": r.url, "status": r.status_code, "reason": r.reason, "encoding": r.encoding,
+                "headers": {name: r.headers[name] for name in ["Content-Type", "Date"] if name in r.headers}}
+        self.__write(path, gzip.compress(json.dumps(meta).encode("utf-8") + b"\n" + body))
+        self.__count("recorded")
+
+        return self.__build(meta, body)
+
+
+    def array(self, filename, variable, index, read):
+        """Returns the slice of variable in filename (as read by read()),
+        if recording it is read and stored (see ThreddsCache.read for the arguments)"""
+        return self.arrays(filename, variable, index, lambda: {"data": read()})["data"]
+
+
+    def arrays(self, filename, name, index, read):
+        """Returns the dict of arrays (like the static fields of a file) identified by filename, name and index,
+        if recording it is read by read() and stored"""
+        description = filename + " " + name + " " + str(index)
+        path = self.__path(ThreddsCache.ThreddsCache.key(filename, name, index), ".npz")
+
+        if self.mode == "replay":
+            try:
+                with np.load(path, allow_pickle=False) as npz:
+                    arrays = {key: npz[key] for key in npz.files}
+            except OSError:
+                raise Exception("Not in the archive " + self.directory + ": " + description)
+            self.__count("replayed")
+            return arrays
+
+        arrays = {key: np.asarray(value) for key, value in read().items()}
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        self.__write(path, buffer.getvalue())
+        self.__count("recorded")
+
+        return arrays
+
+
+    def __path(self, key, suffix):
+        # NOTE: The entries are spread over subdirectories to keep the directories small
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+
+    @staticmethod
+    def __write(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with ThreddsUtils.atomic_path(path) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+
+
+    @staticmethod
+    def __build(meta, body):
+        """Response with the stored status, headers and body
+        (the body can be read through r.raw as well, as for streamed requests)"""
+        r = requests.Response()
+        r.url = meta["url"]
+        r.status_code = meta["status"]
+        r.reason = meta["reason"]
+        r.encoding = meta["encoding"]
+        r.headers = CaseInsensitiveDict(meta["headers"])
+        r.headers["Content-Length"] = str(len(body))
+        r.raw = io.BytesIO(body)
+        return r
+
+
+    def __count(self, name):
+        with self.__lock:
+            setattr(self, name, getattr(self, name) + 1)
+        Instrumentation.default().count("archive." + name)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+def configure(directory, mode="replay"):
+    """Activates the archive in directory for all importers (or deactivates it if directory is None)"""
+    global _default
+    with _default_lock:
+        _default = IOArchive(directory, mode) if directory is not None else None
+        return _default
+
+
+def default():
+    """The active IOArchive (or None if the remote I/O is not recorded or replayed)"""
+    return _default
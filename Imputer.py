@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""Imputation of missing observations in time series
+
+The time series is evaluated at the requested times in one vectorized pass over all columns:
+- "nearest": value of the nearest observation in time
+- "forward": value of the last observation before (or at) the time
+- "linear": linear interpolation in time between the surrounding observations (per column)
+Values are only imputed if the observation that is used is at most max_gap away,
+otherwise they stay missing. Besides the values a mask tells which values are imputed.
+
+Usage (see DataImporter.imput_missing_data):
+'imputer = Imputer.Imputer("nearest", max_gap=pd.Timedelta(hours=3))'
+'ts, imputed = imputer.impute(timeseries, data["time"], "referenceTime")'
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+METHODS = ["nearest", "forward", "linear"]
+
+
+class Imputer:
+    def __init__(self, method="nearest", max_gap=None):
+        """ Initialisation of Imputer Class
+        method: "nearest", "forward" or "linear"
+        max_gap: maximal time (pd.Timedelta) to the observation used for imputation (None for unlimited)
+        """
+        if method not in METHODS:
+            raise ValueError("Unknown imputation method " + str(method) + " (use one of " + ", ".join(METHODS) + ")")
+        self.method = method
+        self.max_gap = None if max_gap is None else pd.Timedelta(max_gap)
+
+
+    def impute(self, timeseries, times, time_col="referenceTime"):
+        """Evaluates timeseries (with the times in the column time_col) at times.
+        Returns the data frame with one row per time (observed or imputed values)
+        and a boolean data frame of the same shape marking the imputed values"""
+        times = pd.DatetimeIndex(times)
+
+        # NOTE: The observations have to be sorted and unique in time for the lookups
+        ts = timeseries.sort_values(time_col, kind="stable")
+        ts = ts.loc[~ts[time_col].duplicated()]
+        source = pd.DatetimeIndex(ts[time_col])
+        columns = [c for c in ts.columns if c != time_col]
+
+        exact = source.get_indexer(times)
+        observed = exact >= 0
+
+        if self.method == "forward":
+            indexer = source.get_indexer(times, method="pad", tolerance=self.max_gap)
+        else:
+            indexer = source.get_indexer(times, method="nearest", tolerance=self.max_gap)
+        indexer = np.where(observed, exact, indexer)
+        found = indexer >= 0
+
+        # Taking whole rows for all columns at once
+        df = ts[columns].iloc[np.where(found, indexer, 0)].reset_index(drop=True)
+        df.loc[~found, columns] = np.nan
+
+        if self.method == "linear":
+            x = times.asi8.astype("float64")
+            for c in columns:
+                if not pd.api.types.is_numeric_dtype(ts[c]):
+                    # NOTE: Non-numeric columns keep the value of the nearest observation
+                    continue
+                valid = ts[c].notna().values
+                if valid.sum() == 0:
+                    continue
+                xp = source.asi8[valid].astype("float64")
+                values = np.interp(x, xp, ts[c].values[valid].astype("float64"), left=np.nan, right=np.nan)
+                df[c] = np.where(observed, df[c].values, np.where(found, values, np.nan)).astype(np.result_type(ts[c].dtype, np.float32), copy=False)
+
+        df.insert(0, time_col, times)
+
+        imputed = pd.DataFrame(np.repeat((found & ~observed)[:, None], len(columns), axis=1), columns=columns, index=times)
+        imputed = imputed & df[columns].notna().values
+
+        return df, imputed
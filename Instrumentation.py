@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""Logging, timing and counters for the importers
+
+- Log messages are printed and buffered, the buffer is written to log.txt (plain text as before)
+  and to log.jsonl (one JSON record per message with time, component and stage) in batches
+- Timing spans for the stages of the pipeline (nested spans are named "outer/inner")
+- Counters (like HTTP requests and bytes, netCDF opens, cache hits)
+- A run summary with all spans and counters as JSON
+  (all since the start of the process or only since a snapshot, like for one dataset of many in the same process)
+
+Usage:
+'instrumentation = Instrumentation.default()'
+'instrumentation.log("Fetching data", "DataImporter")'
+'with instrumentation.span("norkyst"): ...'
+'instrumentation.count("netcdf.opens")'
+'instrumentation.write_summary("run_summary.json")'
+'snapshot = instrumentation.snapshot()' ... 'instrumentation.write_summary("run_summary.json", since=snapshot)'
+
+"""
+
+import json
+import time
+import atexit
+import threading
+import datetime
+
+import ThreddsUtils
+
+
+class Instrumentation:
+    def __init__(self, log_file="log.txt", json_log_file="log.jsonl", buffer_size=100):
+        """ Initialisation of Instrumentation Class
+        log_file: text log (None for no file)
+        json_log_file: structured log with one JSON record per line (None for no file)
+        buffer_size: number of messages that are buffered before they are written
+        """
+        self.log_file = log_file
+        self.json_log_file = json_log_file
+        self.buffer_size = buffer_size
+
+        self.started = time.time()
+        # counters by name
+        self.counters = {}
+        # spans by name: number of calls and total seconds
+        self.spans = {}
+
+        self.__buffer = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+
+    def log(self, msg, component=None):
+        """Prints msg and adds it to the buffer"""
+        print(msg)
+        record = {"time": datetime.datetime.utcnow().isoformat(timespec="milliseconds"),
+                  "component": component, "stage": self.current_span(), "msg": msg}
+        with self.__lock:
+            self.__buffer.append(record)
+            full = len(self.__buffer) >= self.buffer_size
+        if full:
+            self.flush()
+
+
+    def flush(self):
+        """Writes the buffered messages to the log files"""
+        with self.__lock:
+            records, self.__buffer = self.__buffer, []
+            if len(records) == 0:
+                return
+            if self.log_file is not None:
+                with open(self.log_file, "a") as f:
+                    f.write("".join(record["msg"] + "\n" for record in records))
+            if self.json_log_file is not None:
+                with open(self.json_log_file, "a") as f:
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+    def count(self, name, n=1):
+        """Increments the counter `name` by n"""
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def span(self, name):
+        """Context manager measuring the time of the enclosed stage"""
+        return _Span(self, name)
+
+
+    def current_span(self):
+        stack = getattr(self.__local, "stack", [])
+        if len(stack) == 0:
+            return None
+        return stack[-1]
+
+
+    def _enter(self, name):
+        stack = getattr(self.__local, "stack", None)
+        if stack is None:
+            stack = self.__local.stack = []
+        if len(stack) > 0:
+            name = stack[-1] + "/" + name
+        stack.append(name)
+        return name
+
+
+    def _exit(self, name, seconds, failed):
+        self.__local.stack.pop()
+        with self.__lock:
+            span = self.spans.setdefault(name, {"calls": 0, "seconds": 0.0, "failures": 0})
+            span["calls"] += 1
+            span["seconds"] += seconds
+            if failed:
+                span["failures"] += 1
+
+
+    def snapshot(self):
+        """The current spans and counters (for a summary of what happens afterwards, see summary)"""
+        with self.__lock:
+            return {"started": time.time(),
+                    "spans": {name: dict(span) for name, span in self.spans.items()},
+                    "counters": dict(self.counters)}
+
+
+    def summary(self, since=None, **extra):
+        """The spans and counters (and any further information given as keyword arguments) as dict.
+        With since (a snapshot) only the spans and counts after the snapshot are summarised"""
+        if since is None:
+            since = {"started": self.started, "spans": {}, "counters": {}}
+        current = self.snapshot()
+
+        # NOTE: The instrumentation is shared by the process, what happened before since is subtracted
+        spans = {}
+        for name, span in current["spans"].items():
+            before = since["spans"].get(name, {})
+            if span["calls"] > before.get("calls", 0):
+                spans[name] = {key: value - before.get(key, 0) for key, value in span.items()}
+        counters = {name: n - since["counters"].get(name, 0) for name, n in current["counters"].items()
+                    if n != since["counters"].get(name, 0)}
+
+        summary = {"started": datetime.datetime.utcfromtimestamp(since["started"]).isoformat(timespec="seconds"),
+                   "seconds": current["started"] - since["started"],
+                   "spans": spans,
+                   "counters": counters}
+        summary.update(extra)
+        return summary
+
+
+    def write_summary(self, filename, since=None, **extra):
+        """Writes the summary (see summary) as JSON to filename"""
+        self.flush()
+        with ThreddsUtils.atomic_path(filename) as tmp_filename:
+            with open(tmp_filename, "w") as f:
+                json.dump(self.summary(since, **extra), f, indent=1)
+
+
+class _Span:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.full_name = self.instrumentation._enter(self.name)
+        self.tic = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation._exit(self.full_name, time.time() - self.tic, exc_type is not None)
+        return False
+
+
+_default = None
+_default_lock = threading.Lock()
+
+def default():
+    """The Instrumentation shared by all importers"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Instrumentation()
+            atexit.register(_default.flush)
+        return _default
@@ -16,10 +16,19 @@ Find sea surface elevation (no use of --depth):
 Find first available timestep before given start time and after given end time for temperature at depth 100 m:
 'python3 NorKystImporter.py -lon 3 -lat 60 -depth 100 -param temperature -S 2021-04-11T00:45 -E 2021-04-14T11:15'
 
+For many stations use `norkyst_data_stations` with a list of (station_id, lon, lat), 
+which opens every daily file only once and extracts all stations from it.
+
+The daily files can be read concurrently in worker processes (e.g. '-workers 8', see ThreddsUtils.read_files), 
+files that cannot be read are listed in `failures`.
+For offline runs `filename_format` can point to local copies of the files.
+
+Find several params (multi-level and single-level) in the same fetch:
+'python3 NorKystImporter.py -lon 3 -lat 60 -depth 10 -param temperature -param salinity -param zeta -S 2021-04-11T00:00 -E 2021-04-14T23:00'
+
 TODO:
  - More error handling
  - Tune processing and storing of observational data sets (to suite whatever code that will use the data sets)
- - Nice to have: Make it possible to get multi-level and single-level params in the same fetch
  - (See TODOs in FrostImporter.py)
  - ...
 
@@ -29,31 +38,54 @@ import argparse
 import time
 import datetime
 from traceback import format_exc
-import netCDF4
 import numpy as np
-import pyproj as proj
 import sys
-import pandas as pd 
+
+import GridIndex
+import ThreddsUtils
 
 import matplotlib.pyplot as plt
 
 class NorKystImporter:
-    def __init__(self, start_time=None, end_time=None):
+    # size of the tiles (in grid cells) whose points are read in one block (see blocks)
+    BLOCK_SIZE = 64
+    # the points of a tile are read as one block only if its bounding box has at most CELLS_PER_POINT cells per point
+    CELLS_PER_POINT = 16
+
+    def __init__(self, start_time=None, end_time=None, workers=1, 
+        filename_format="https://thredds.met.no/thredds/dodsC/fou-hi/norkyst800m-1h/NorKyst-800m_ZDEPTHS_his.an.%Y%m%d00.nc",
+        cache=None, manifest=None):
+        """ Initialisation of NorKystImporter Class
+        workers: number of worker processes that read files concurrently (1 for reading in this process)
+        filename_format: strftime format for the daily files (can point to a local directory as well)
+        cache: ThreddsCache for the fetched slices (or None)
+        manifest: ThreddsManifest to select the existing files (or None to probe for the first existing file)
+        """
+
+        self.workers = workers
+        self.filename_format = filename_format
+        self.cache = cache
+        self.manifest = manifest
+
+        self.filenames = None
+        # list of (filename, error message) for files that could not be read
+        self.failures = []
+
+        self.x1 = None
+        self.y1 = None
 
         if start_time is None:
-            lon, lat, depth, params, start_time, end_time = self.__parse_args()
+            lon, lat, depth, params, start_time, end_time, self.workers = self.__parse_args()
 
             self.start_time = datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
             self.end_time = datetime.datetime.strptime(end_time, "%Y-%m-%dT%H:%M")
  
-            data = {}
-            for param in params:
-                data[param] = self.norkyst_data(param, lon, lat, self.start_time, self.end_time, depth)
-                print(data[param])
+            data = self.norkyst_data(params, lon, lat, self.start_time, self.end_time, depth)
+            print(data)
 
             # plots first param
             fig = plt.figure()
-            plt.plot(data[params[0]]["referenceTime"],data[params[0]][params[0]+depth])
+            plt.plot(data["referenceTime"],data[data.columns[0]])
             plt.show()
             plt.savefig("fig.png")
 
@@ -61,17 +93,12 @@ class NorKystImporter:
             self.start_time = start_time
             self.end_time = end_time
 
-            self.filenames = None
-
-            self.x1 = None
-            self.y1 = None
-
 
     @staticmethod
     def daterange(start_date, end_date):
         # +1 to include end_date 
-        # and +1 in case the time interval is not divisible with 24 hours (to get the last hours into the last day)
-        for i in range(int((end_date - start_date).days + 1)):
+        # (counting calendar days such that the last hours get into the last day)
+        for i in range(int((end_date.date() - start_date.date()).days + 1)):
             yield (start_date + datetime.timedelta(i)).date()
 
     def norkyst_filenames(self):
@@ -82,25 +109,73 @@ class NorKystImporter:
 
         # add all days in specified time interval (including the day self.end_time)
         for single_date in self.daterange(self.start_time, self.end_time):
-            filenames.append(
-                single_date.strftime("https://thredds.met.no/thredds/dodsC/fou-hi/norkyst800m-1h/NorKyst-800m_ZDEPTHS_his.an.%Y%m%d00.nc"))
+            filenames.append(single_date.strftime(self.filename_format))
 
         #NOTE: For some days there do not exist files in the THREDDS catalog.
-        # The list of filenames is cleaned such that the first filename is valid
-        testing = True
-        while testing:
-            try: 
-                nc = netCDF4.Dataset(filenames[0])
-                testing = False
-            except:
-                filenames.pop(0)
+        # With a manifest only the files listed in the catalog are kept,
+        # otherwise the list of filenames is cleaned such that the first filename is valid
+        if self.manifest is not None:
+            filenames = self.manifest.filter(filenames)
+            if len(filenames) == 0:
+                raise Exception("No NorKyst files available for the period")
+            return filenames
+
+        while not ThreddsUtils.probe(filenames[0]):
+            filenames.pop(0)
 
         return filenames
 
 
     def norkyst_data(self, param, lon, lat, start_time=None, end_time=None, depth=0):
         """Fetches relevant netCDF files from THREDDS 
-        and constructs a timeseries in a data frame"""
+        and constructs a timeseries in a data frame
+
+        param can be a single variable or a list of variables which are all fetched in one visit per file,
+        depth is a depth (or list of depths) used for all multi-level variables 
+        or a dict with the depth(s) per variable. 
+        Single-level variables (like zeta) ignore the depth"""
+
+        if self.filenames is None:
+            # Filenames for fetching
+            self.filenames = self.norkyst_filenames()
+
+        if self.x1 is None:
+            # Use first file to specify the coordinates
+            ys, xs = self.__wet_cells(self.filenames[0], [lon], [lat])
+            self.y1, self.x1 = ys[0], xs[0]
+
+        timeseries = self.__points_data({0: (self.y1, self.x1)}, param, start_time, end_time, depth)
+
+        return timeseries[0]
+
+
+    def norkyst_data_stations(self, stations, param, start_time=None, end_time=None, depth=0):
+        """Fetches relevant netCDF files from THREDDS for many stations at once
+        where stations is a list of (station_id, lon, lat).
+        Every daily file is opened only once and the data for all stations is read from it,
+        returns a dict with a timeseries data frame per station_id
+        (param and depth as in norkyst_data)"""
+
+        if self.filenames is None:
+            # Filenames for fetching
+            self.filenames = self.norkyst_filenames()
+
+        # Use first file to specify the coordinates of all stations at once
+        station_ids = [station[0] for station in stations]
+        lons = [float(station[1]) for station in stations]
+        lats = [float(station[2]) for station in stations]
+        ys, xs = self.__wet_cells(self.filenames[0], lons, lats)
+
+        points = {}
+        for i in range(len(station_ids)):
+            points[station_ids[i]] = (ys[i], xs[i])
+
+        return self.__points_data(points, param, start_time, end_time, depth)
+
+
+    def __points_data(self, points, params, start_time=None, end_time=None, depth=0):
+        """Loops over the THREDDS files and constructs a timeseries 
+        for each (y, x) grid point in points (dict of key: (y, x))"""
 
         # using member variables if applicable
         if start_time is None:
@@ -108,122 +183,185 @@ class NorKystImporter:
         if end_time is None:
             end_time = self.end_time
 
-        if self.filenames is None:
-            # Filenames for fetching
-            self.filenames = self.norkyst_filenames()
+        if not isinstance(params, list):
+            params = [params]
 
-        # Load first object
-        # and use it to specify the coordinates
-        nc = netCDF4.Dataset(self.filenames[0])
         print("- " + time.strftime("%H:%M:%S", time.gmtime()) + " -")
 
-        if self.x1 is None:
-            # handle projection
-            for var in ['polar_stereographic','projection_stere','grid_mapping']:
-                if var in nc.variables.keys():
-                    try:
-                        proj1 = nc.variables[var].proj4
-                    except:
-                        proj1 = nc.variables[var].proj4string
-            p1 = proj.Proj(str(proj1))
-            xp1,yp1 = p1(lon,lat)
-            for var in ['latitude','lat']:
-                if var in nc.variables.keys():
-                    lat1 = nc.variables[var][:]
-            for var in ['longitude','lon']:
-                if var in nc.variables.keys():
-                    lon1 = nc.variables[var][:]
-            xproj1,yproj1 = p1(lon1,lat1)
-
-            # find coordinate of gridpoint to analyze (only wet cells)
-            h = np.array(nc["h"])
-            land_value = h.min()
-            land_mask = np.where((h!=land_value),0,1)
-            distances = (xproj1-xp1)**2 + (yproj1-yp1)**2 + land_mask*1e12
-            self.y1, self.x1 = np.unravel_index(distances.argmin(), distances.shape)
-
-            print('Coordinates model (x,y= '+str(self.x1)+','+str(self.y1)+'): '+str(lat1[self.y1,self.x1])+', '+str(lon1[self.y1,self.x1]))
-
-        # find correct depth index
-        all_depths = nc.variables["depth"][:]
-        if isinstance(depth, list):
-            depth_index = []
-            for d in depth:
-                depth_index.append(np.where(all_depths == int(d))[0][0])
-        else:
-            depth_index = np.where(all_depths == int(depth))[0][0]
-
-        # find correct time indices for start and end of timeseries
-        times = nc.variables["time"]
-        try:
-            t1 = netCDF4.date2index(start_time, times, calendar=times.calendar, select="before")
-            t1 = max(0,t1)
-        except:
-            t1 = 0
-        
-        # FIRST FILE
-        timeseries = self.data1file(self.filenames[0],self.y1,self.x1,param,depth,depth_index,t1=t1)
-
-        # LOOP OVER EACH FILE
-        for i in range(1,len(self.filenames)-1):
-            try:
-                new_timeseries = self.data1file(self.filenames[i],self.y1,self.x1,param,depth,depth_index)
-                timeseries = pd.concat([timeseries,new_timeseries], ignore_index=True)
-            except:
-                pass
-
-        # LAST FILE
-        try:
-            nc = netCDF4.Dataset(self.filenames[-1])
-            times = nc.variables["time"]
-            try:
-                t2 = netCDF4.date2index(end_time, times, calendar=times.calendar, select="after")
-            except:
-                t2 = len(times[:])
-
-            new_timeseries = self.data1file(self.filenames[-1],self.y1,self.x1,param,depth,depth_index,t2=t2)
-            timeseries = pd.concat([timeseries,new_timeseries], ignore_index=True)
-        except:
-            pass
-
-        #NOTE: Since the other data sources explicitly specify the time zone
-        # the tz is manually added to the datetime here
-        timeseries["referenceTime"] = timeseries["referenceTime"].dt.tz_localize(tz="UTC")         
-
-        return timeseries
+        # find correct depth index per variable
+        # (None for single-level variables)
+        with ThreddsUtils.LazyDataset(self.filenames[0]) as nc:
+            all_depths = ThreddsUtils.read_slice(nc, "depth", slice(None), self.cache)
+            specs = []
+            for param in params:
+                param_depth = depth.get(param) if isinstance(depth, dict) else depth
+                if ThreddsUtils.read_ndim(nc, param, self.cache) < 4:
+                    specs.append((param, None, None))
+                else:
+                    if param_depth is None:
+                        param_depth = 0
+                    if isinstance(param_depth, list):
+                        depth_index = []
+                        for d in param_depth:
+                            depth_index.append(np.where(all_depths == int(d))[0][0])
+                    else:
+                        depth_index = np.where(all_depths == int(param_depth))[0][0]
+                    specs.append((param, param_depth, depth_index))
+
+        # NOTE: The files are read concurrently (in self.workers worker processes, see ThreddsUtils.read_files),
+        # the time window is only applied to the first and the last file,
+        # their time indices are found from the times read with the data
+        blocks, reads = self.reads(points, specs)
+        results, failures = ThreddsUtils.read_files(self.filenames, reads, self.workers, self.cache)
+
+        for filename, err in failures:
+            print("Failed to read " + filename + ": " + err)
+            self.failures.append((filename, err))
+
+        # NOTE: The per-point arrays are collected in lists (in time order)
+        # and the data frames are built only once in the end
+        last = len(self.filenames)-1
+        chunks = {key: [] for key in points.keys()}
+        for i in range(len(self.filenames)):
+            if results[i] is None:
+                continue
+            columns = self.columns(self.filenames[i], points, specs, blocks, results[i],
+                start_time=(start_time if i == 0 else None), end_time=(end_time if i == last else None))
+            for key in points.keys():
+                chunks[key].append(columns[key])
+
+        data = {}
+        for key in points.keys():
+            if len(chunks[key]) == 0:
+                raise Exception("No NorKyst data could be read for the period")
+            data[key] = ThreddsUtils.assemble(chunks[key])
+
+        return data
+
 
     def data1file(self,filename,y1,x1,param,depth,depth_index,t1=0,t2=None):
-        nc = netCDF4.Dataset(filename)
+        chunk = self.points1file(filename,{0: (y1, x1)},[(param,depth,depth_index)],t1=t1,t2=t2)[0]
+        return ThreddsUtils.assemble([chunk])
+
+
+    def points1file(self,filename,points,specs,t1=0,t2=None,start_time=None,end_time=None):
+        """Opens the file once and extracts the timeseries for all (y, x) in points 
+        and all variables in specs (list of (param, depth, depth_index), depth_index is None for single-level variables)
+        (the file is not opened at all if all slices are cached).
+        Returns a dict with the columns (as arrays, see ThreddsUtils.assemble) per point (see columns)"""
+        blocks, reads = self.reads(points, specs)
+        results, failures = ThreddsUtils.read_files([filename], reads, 1, self.cache)
+        if results[0] is None:
+            raise Exception("Failed to read " + filename + ": " + failures[0][1])
+        return self.columns(filename, points, specs, blocks, results[0], t1, t2, start_time, end_time)
+
+
+    def reads(self, points, specs):
+        """The blocks of points (see blocks) and the slices to read from every file (see ThreddsUtils.read_files):
+        the times and per block the variables in specs"""
+        # NOTE: The whole day is read (and cached) and sliced locally,
+        # such that the cached slices are the same whether the file is the first, a middle or the last file of a period
+        blocks = self.blocks(points)
+        reads = [("time", slice(None))]
+        for ys, xs, _ in blocks:
+            for param, _, depth_index in specs:
+                if depth_index is None:
+                    reads.append((param, (slice(None),ys,xs)))
+                else:
+                    reads.append((param, (slice(None),depth_index,ys,xs)))
+        return blocks, reads
+
+
+    def columns(self,filename,points,specs,blocks,arrays,t1=0,t2=None,start_time=None,end_time=None):
+        """Extracts the timeseries for all points from the slices read from filename (see reads).
+        The time indices t1 and t2 are taken from start_time and end_time if given (see ThreddsUtils.start_index and end_index).
+        Returns a dict with the columns (as arrays, see ThreddsUtils.assemble) per point"""
         print("- " + time.strftime("%H:%M:%S", time.gmtime()) + " -")
         print("Processing ", filename)
         # EXTRACT REFERENCE TIMES
-        # the times fetched from Thredds are in the cftime.GregorianDatetime format,
-        # but since pandas does not understand that format we have to cast to datetime by hand
-        cftimes = netCDF4.num2date(nc.variables["time"][t1:t2], nc.variables["time"].units)
-        datetimes = self.__cftime2datetime(cftimes)
-
-        # FIRST DATA
-        data = nc.variables[param][t1:t2,depth_index,y1,x1]
-        # Dataframe for return
-        timeseries = pd.DataFrame(data)
-        timeseries["referenceTime"] = datetimes 
-        
-        if isinstance(depth, list): 
-            for d in range(len(depth)):
-                timeseries = timeseries.rename(columns={d:param+str(depth[d])})
-        else:
-            timeseries = timeseries.rename(columns={"0":str(depth)})
-
-        return timeseries
+        times = arrays[0]
+        if start_time is not None:
+            t1 = ThreddsUtils.start_index(times, start_time)
+        if end_time is not None:
+            t2 = ThreddsUtils.end_index(times, end_time)
+        datetimes = times[t1:t2].asi8
+
+        # NOTE: The points are read block by block (one read per block of nearby points and variable)
+        # and the points are picked from the block locally
+        data = {key: {} for key in points.keys()}
+        j = 1
+        for ys, xs, keys in blocks:
+            for param, depth, depth_index in specs:
+                values = arrays[j][t1:t2]
+                j += 1
+
+                for key in keys:
+                    y1, x1 = points[key]
+                    if isinstance(ys, slice):
+                        point_values = values[..., int(y1)-ys.start, int(x1)-xs.start]
+                    else:
+                        point_values = values
+                    if depth_index is None:
+                        data[key][param] = point_values
+                    elif isinstance(depth, list):
+                        for d in range(len(depth)):
+                            data[key][param+str(depth[d])] = point_values[:,d]
+                    else:
+                        data[key][param+str(depth)] = point_values
+
+        for key in points.keys():
+            data[key]["referenceTime"] = datetimes
+
+        return data
+
+
+    @classmethod
+    def blocks(cls, points):
+        """Groups the points (dict of key: (y, x)) into blocks of nearby points 
+        (points in the same tile of BLOCK_SIZE x BLOCK_SIZE grid cells 
+        whose bounding box has at most CELLS_PER_POINT cells per point, otherwise the tile is split in quarters).
+        Returns a list of (y slice, x slice, keys) with the bounding box of the points in each block
+        or (y, x, keys) for the points in a single cell"""
+        return cls.__blocks(points, list(points.keys()), cls.BLOCK_SIZE)
+
+
+    @classmethod
+    def __blocks(cls, points, keys, size):
+        tiles = {}
+        for key in keys:
+            y, x = points[key]
+            tiles.setdefault((int(y)//size, int(x)//size), []).append(key)
+
+        blocks = []
+        for keys in tiles.values():
+            ys = [int(points[key][0]) for key in keys]
+            xs = [int(points[key][1]) for key in keys]
+            cells = (max(ys) - min(ys) + 1)*(max(xs) - min(xs) + 1)
+            if cells == 1:
+                # NOTE: A single cell is read with integer indices (as for a single station),
+                # such that its cached slices are shared with single-station runs
+                blocks.append((ys[0], xs[0], keys))
+            elif cells <= cls.CELLS_PER_POINT*len(keys):
+                blocks.append((slice(min(ys), max(ys)+1), slice(min(xs), max(xs)+1), keys))
+            else:
+                blocks.extend(cls.__blocks(points, keys, size//2))
+        return blocks
 
 
     @staticmethod
-    def __cftime2datetime(cftimes):
-        datetimes = []
-        for t in range(len(cftimes)):
-            new_datetime = datetime.datetime(cftimes[t].year, cftimes[t].month, cftimes[t].day, cftimes[t].hour, cftimes[t].minute)
-            datetimes.append(new_datetime)
-        return datetimes
+    def __wet_cells(filename, lons, lats):
+        """Finding the indices (y, x) of the grid cell that contains the station 
+        or is the closest wet cell for each of the given coordinates"""
+        # NOTE: The grid index is built from the static fields in filename only once 
+        # and then loaded from the local storage
+        index = GridIndex.GridIndex.load("norkyst800", filename, wet_only=True)
+        i = index.query(lons, lats)
+        ys, xs = index.cells["y"][i], index.cells["x"][i]
+
+        for j in range(len(i)):
+            print('Coordinates model (x,y= '+str(xs[j])+','+str(ys[j])+'): '+str(index.cells["lat"][i[j]])+', '+str(index.cells["lon"][i[j]]))
+
+        return ys, xs
 
 
     @staticmethod
@@ -248,39 +386,21 @@ class NorKystImporter:
         parser.add_argument(
             '-E', '--end-time', required=True,
             help='end time in ISO format (YYYY-MM-DDTHH:MM) UTC')
+        parser.add_argument(
+            '-workers', default=1, type=int,
+            help='number of worker processes that read files concurrently')
         res = parser.parse_args(sys.argv[1:])
-        return res.lon, res.lat, res.depth, res.param, res.start_time, res.end_time
+        return res.lon, res.lat, res.depth, res.param, res.start_time, res.end_time, res.workers
 
 
     @staticmethod
     def simulated_depth(lat, lon):
         """returning H for the grid cell that contains the station or is the closest wet cell"""
-        nc = netCDF4.Dataset('https://thredds.met.no/thredds/dodsC/fou-hi/norkyst800m-1h/NorKyst-800m_ZDEPTHS_his.an.2021100100.nc')
-        # handle projection
-        for var in ['polar_stereographic','projection_stere','grid_mapping']:
-            if var in nc.variables.keys():
-                try:
-                    proj1 = nc.variables[var].proj4
-                except:
-                    proj1 = nc.variables[var].proj4string
-        p1 = proj.Proj(str(proj1))
-        xp1,yp1 = p1(lon,lat)
-        for var in ['latitude','lat']:
-            if var in nc.variables.keys():
-                lat1 = nc.variables[var][:]
-        for var in ['longitude','lon']:
-            if var in nc.variables.keys():
-                lon1 = nc.variables[var][:]
-        xproj1,yproj1 = p1(lon1,lat1)
-
-        # find coordinate of gridpoint to analyze (only wet cells)
-        h = np.array(nc["h"])
-        land_value = h.min()
-        land_mask = np.where((h!=land_value),0,1)
-        distances = (xproj1-xp1)**2 + (yproj1-yp1)**2 + land_mask*1e12
-        y1, x1 = np.unravel_index(distances.argmin(), distances.shape)
-
-        return nc.variables["h"][y1,x1].data.item()
+        index = GridIndex.GridIndex.load("norkyst800",
+            'https://thredds.met.no/thredds/dodsC/fou-hi/norkyst800m-1h/NorKyst-800m_ZDEPTHS_his.an.2021100100.nc', wet_only=True)
+        i = index.query([lon], [lat])[0]
+
+        return float(index.cells["h"][i])
 
 
 if __name__ == "__main__":
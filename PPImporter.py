@@ -11,6 +11,9 @@ Test:
 Find sea surface elevation (no use of --depth):
 'python3 PPImporter.py -lon 10.7166638 -lat 59.933329 -S 2021-09-18T00:00 -E 2021-09-19T23:59'
 
+The hourly files can be read concurrently in worker processes (e.g. '-workers 16', see ThreddsUtils.read_files), 
+the throughput (files/s) is reported.
+
 IDEA: 
 Use forecast weather data instead of observation weather data.
 See the MET post-processed data on https://thredds.met.no/thredds/metno.html > products/Archive/Operational/
@@ -20,19 +23,35 @@ import argparse
 import time
 import datetime
 from traceback import format_exc
-import netCDF4
-import numpy as np
-import pyproj as proj
 import sys
-import pandas as pd 
+
+import GridIndex
+import ThreddsUtils
 
 import matplotlib.pyplot as plt
 
 class PPImporter:
-    def __init__(self, start_time=None, end_time=None):
+    def __init__(self, start_time=None, end_time=None, cache=None, workers=1,
+        archive_url="https://thredds.met.no/thredds/dodsC", manifest=None):
+        """ Initialisation of PPImporter Class
+        cache: ThreddsCache for the fetched slices (or None)
+        workers: number of worker processes that read hourly files concurrently (1 for reading in this process)
+        archive_url: location of the metpparchive(v2) directories (can point to a local directory as well)
+        manifest: ThreddsManifest to select the existing files (or None)
+        """
+
+        self.cache = cache
+        self.manifest = manifest
+        self.workers = workers
+        self.archive_url = archive_url
+
+        # list of (filename, error message) for files that could not be read
+        self.failures = []
+        # files per second of the last pp_data call
+        self.throughput = None
 
         if start_time is None:
-            lon, lat, params, start_time, end_time = self.__parse_args()
+            lon, lat, params, start_time, end_time, self.workers = self.__parse_args()
 
             self.start_time = datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
             self.end_time = datetime.datetime.strptime(end_time, "%Y-%m-%dT%H:%M")
@@ -67,147 +86,129 @@ class PPImporter:
 
         return dates
 
-    def pp_filenames(self):
+    def pp_filenames(self, start_time=None, end_time=None):
         """Constructing list with filenames of the individual THREDDS netCDF files 
-        for the relevant time period"""
+        for the relevant time period (self.start_time and self.end_time if not given)"""
 
-        filenames = []
-        print("Filename timestamp based on start_time: " + self.start_time.strftime("%Y%m%d%H"))
-        print("Filename timestamp based on end_time: " + self.end_time.strftime("%Y%m%d%H"))
+        # using member variables if applicable
+        if start_time is None:
+            start_time = self.start_time
+        if end_time is None:
+            end_time = self.end_time
 
-        # add all days in specified time interval (including the day self.end_time)
-        for single_date in self.daterange(self.start_time, self.end_time):
+        filenames = []
+        print("Filename timestamp based on start_time: " + start_time.strftime("%Y%m%d%H"))
+        print("Filename timestamp based on end_time: " + end_time.strftime("%Y%m%d%H"))
+
+        # add all hours in specified time interval 
+        # (from the hour of self.start_time up to the first hour after self.end_time)
+        last_hour = end_time.replace(minute=0, second=0, microsecond=0)
+        if last_hour < end_time:
+            last_hour = last_hour + datetime.timedelta(hours=1)
+        for single_date in self.daterange(start_time, end_time):
+            if single_date.replace(minute=0, second=0, microsecond=0) > last_hour:
+                break
             if single_date.year >= 2020:
                 filenames.append(
-                    single_date.strftime("https://thredds.met.no/thredds/dodsC/metpparchive/%Y/%m/%d/met_analysis_1_0km_nordic_%Y%m%dT%HZ.nc"))
+                    single_date.strftime(self.archive_url + "/metpparchive/%Y/%m/%d/met_analysis_1_0km_nordic_%Y%m%dT%HZ.nc"))
             else:
                 filenames.append(
-                    single_date.strftime("https://thredds.met.no/thredds/dodsC/metpparchivev2/%Y/%m/%d/met_analysis_1_0km_nordic_%Y%m%dT%HZ.nc"))
-
-        # Only assuring that the first listed filename is valid 
-        # (Later invalid filenames are gonna be detected later)
-        testing = True
-        while testing:
-            try: 
-                nc = netCDF4.Dataset(filenames[0])
-                testing = False
-            except:
-                filenames.pop(0)
+                    single_date.strftime(self.archive_url + "/metpparchivev2/%Y/%m/%d/met_analysis_1_0km_nordic_%Y%m%dT%HZ.nc"))
+
+        # NOTE: The filenames are not probed here. 
+        # With a manifest only the files listed in the catalog are kept,
+        # otherwise files that do not exist are recorded as failures when they are read
+        if self.manifest is not None:
+            filenames = self.manifest.filter(filenames)
+            if len(filenames) == 0:
+                raise Exception("No PP files available for the period")
 
         return filenames
 
 
     def pp_data(self, params, lon, lat, start_time=None, end_time=None):
         """Fetches relevant netCDF files from THREDDS 
-        and constructs a timeseries in a data frame"""
+        and constructs a timeseries in a data frame
 
-        # using member variables if applicable
-        if start_time is None:
-            start_time = self.start_time
-        if end_time is None:
-            end_time = self.end_time
+        Every hourly file is opened only once and all params are read from it,
+        the files are read concurrently (in self.workers worker processes, see ThreddsUtils.read_files)"""
 
         # Filenames for fetching
-        filenames = self.pp_filenames()
+        filenames = self.pp_filenames(start_time, end_time)
 
-        # Load multi-file object
-        nc = netCDF4.Dataset(filenames[0])
-        print("- " + time.strftime("%H:%M:%S", time.gmtime()) + " -")
-        print("Processing", filenames[0])
+        # find coordinate of gridpoint to analyze
+        y, x = self.__grid_point(filenames, lon, lat)
 
-        # handle projection
-        proj_args = nc.variables["projection_lcc"].proj4
-        p = proj.Proj(str(proj_args))
+        tic = time.time()
+        results, failures = ThreddsUtils.read_files(filenames, self.__reads(y,x,params), self.workers, self.cache)
+        toc = time.time()
 
-        xp,yp = p(lon,lat)
-        lats = nc.variables["latitude"][:]
-        lons = nc.variables["longitude"][:]
-        xps,yps = p(lons,lats)
+        for filename, err in failures:
+            print("Failed to read " + filename + ": " + err)
+            self.failures.append((filename, err))
 
-        # find coordinate of gridpoint to analyze
-        x=self.__find_nearest_index(xps[0,:],xp)
-        y=self.__find_nearest_index(yps[:,0],yp)
-
-        print('Coordinates model (x,y= '+str(x)+','+str(y)+'): '+str(lats[y,x])+', '+str(lons[y,x]))
-
-        # DATA FROM FIRST FILE
-        times = nc.variables["time"]
-        try:
-            t1 = netCDF4.date2index(start_time, times, select="before")
-            t1 = max(0,t1)
-        except:
-            t1 = 0
-
-        timeseries = self.data1file(filenames[0],y,x,params,t1=t1)
-        
-        # LOOP OVER DATA FROM EACH MIDDLE FILE
-        for i in range(1,len(filenames)-1):
-            try:
-                middle_timeseries = self.data1file(filenames[i],y,x,params)
-                timeseries = pd.concat([timeseries,middle_timeseries], ignore_index=True)
-            except:
-                pass
-
-        # DATA FROM LAST FILE
-        try: 
-            nc = netCDF4.Dataset(filenames[-1])
-            times = nc.variables["time"] 
-            try:
-                t2 = netCDF4.date2index(end_time, times, select="after")
-            except:
-                t2 = len(times[:])
-            last_timeseries = self.data1file(filenames[-1],y,x,params,t2=t2)
-            timeseries = pd.concat([timeseries,last_timeseries], ignore_index=True)
-        except:
-            pass
+        self.throughput = len(filenames)/max(toc-tic, 1e-6)
+        print("Read " + str(len(filenames)-len(failures)) + " of " + str(len(filenames)) + " files in "
+            + "{:.1f}".format(toc-tic) + " s (" + "{:.2f}".format(self.throughput) + " files/s)")
+
+        # NOTE: The arrays per file are collected in a list (in time order)
+        # and the data frame is built only once in the end
+        chunks = [self.__columns(filename,params,arrays) for filename, arrays in zip(filenames, results) if arrays is not None]
+        if len(chunks) == 0:
+            raise Exception("No PP data could be read for the period")
 
+        timeseries = ThreddsUtils.assemble(chunks)
         timeseries = timeseries.set_index("referenceTime")
 
         return timeseries
 
 
-    def data1file(self,filename,y,x,params,t1=0,t2=None):
-        nc = netCDF4.Dataset(filename)
-        print("- " + time.strftime("%H:%M:%S", time.gmtime()) + " -")
-        print("Processing ", filename)
-        cftimes = netCDF4.num2date(nc.variables["time"][t1:t2], nc.variables["time"].units)
-        datetimes = self.__cftime2datetime(cftimes)
+    def __grid_point(self, filenames, lon, lat):
+        # NOTE: The grid index is built from the static fields of the first readable file only once 
+        # and then loaded from the local storage (one index per archive and archive_url)
+        index = None
+        for filename in filenames:
+            archive = "metpparchivev2" if "metpparchivev2" in filename else "metpparchive"
+            try:
+                index = GridIndex.GridIndex.load(archive, filename, wet_only=False, source=self.archive_url + "/" + archive)
+                break
+            except OSError:
+                continue
+        if index is None:
+            raise Exception("None of the " + str(len(filenames)) + " PP files could be opened to locate the grid point")
+        i = index.query([lon], [lat])[0]
+        y, x = index.cells["y"][i], index.cells["x"][i]
 
-        timeseries = pd.DataFrame()
-        for param in params:
-            # EXTRACT DATA
-            data = nc.variables[param][t1:t2,y,x]
-
-            # Dataframe for return
-            new_timeseries = pd.DataFrame({"referenceTime":datetimes, param:data})
-
-            #NOTE: Since the other data sources explicitly specify the time zone
-            # the tz is manually added to the datetime here
-            new_timeseries["referenceTime"] = new_timeseries["referenceTime"].dt.tz_localize(tz="UTC") 
-            
-            # Outer joining dataset
-            if timeseries.empty:
-                timeseries = new_timeseries
-            else:
-                timeseries = pd.merge(timeseries.set_index("referenceTime"), new_timeseries.set_index("referenceTime")[param], how="outer", on="referenceTime")
-                timeseries = timeseries.reset_index()
+        print('Coordinates model (x,y= '+str(x)+','+str(y)+'): '+str(index.cells["lat"][i])+', '+str(index.cells["lon"][i]))
+
+        return y, x
 
-        return timeseries
+
+    def data1file(self,filename,y,x,params,t1=0,t2=None):
+        results, failures = ThreddsUtils.read_files([filename], self.__reads(y,x,params), 1, self.cache)
+        if results[0] is None:
+            raise Exception("Failed to read " + filename + ": " + failures[0][1])
+        return ThreddsUtils.assemble([self.__columns(filename,params,results[0],t1=t1,t2=t2)])
 
 
     @staticmethod
-    def __cftime2datetime(cftimes):
-        datetimes = []
-        for t in range(len(cftimes)):
-            new_datetime = datetime.datetime(cftimes[t].year, cftimes[t].month, cftimes[t].day, cftimes[t].hour, cftimes[t].minute)
-            datetimes.append(new_datetime)
-        return datetimes
+    def __reads(y,x,params):
+        """The slices to read from every file (see ThreddsUtils.read_files): the times and all params at (y, x)"""
+        # NOTE: The whole file is read (and cached) and sliced locally (see NorKystImporter.reads)
+        return [("time", slice(None))] + [(param, (slice(None),y,x)) for param in params]
 
 
     @staticmethod
-    def __find_nearest_index(array,value):
-        idx = (np.abs(array-value)).argmin()
-        return idx
+    def __columns(filename,params,arrays,t1=0,t2=None):
+        """The columns (as arrays, see ThreddsUtils.assemble) from the slices read from filename (see __reads)"""
+        print("- " + time.strftime("%H:%M:%S", time.gmtime()) + " -")
+        print("Processing ", filename)
+        columns = {"referenceTime": arrays[0][t1:t2].asi8}
+        for param, values in zip(params, arrays[1:]):
+            # EXTRACT DATA
+            columns[param] = values[t1:t2]
+
+        return columns
 
 
     @staticmethod
@@ -228,8 +229,11 @@ class PPImporter:
         parser.add_argument(
             '-E', '--end-time', required=True,
             help='end time in ISO format (YYYY-MM-DDTHH:MM) UTC')
+        parser.add_argument(
+            '-workers', default=1, type=int,
+            help='number of worker processes that read files concurrently')
         res = parser.parse_args(sys.argv[1:])
-        return res.lon, res.lat, res.param, res.start_time, res.end_time
+        return res.lon, res.lat, res.param, res.start_time, res.end_time, res.workers
 
 if __name__ == "__main__":
 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""Local read-through cache for slices of netCDF variables fetched from the MET THREDDS server
+
+Every slice is identified by (file, variable, index) - where the index holds the time slice, depth, y and x -
+and is stored as a numpy binary file in the cache directory.
+The total size of the cache on disk is bounded, the least recently used slices are evicted first.
+The size of a slice is counted in filesystem blocks, as the many small slices (of single points) 
+take much more space on disk than their bytes.
+
+Usage (see NorKystImporter and PPImporter):
+'cache = ThreddsCache.ThreddsCache("cache/thredds", max_bytes=2*1024**3)'
+'data = cache.read(filename, "temperature", (slice(0,24), 0, 100, 200), fetch)'
+
+"""
+
+import os
+import collections
+import hashlib
+import threading
+import numpy as np
+
+import Instrumentation
+import ThreddsUtils
+
+
+class ThreddsCache:
+    def __init__(self, cache_dir=os.path.join("cache", "thredds"), max_bytes=2*1024**3):
+        """ Initialisation of ThreddsCache Class
+        cache_dir: directory where the slices are stored
+        max_bytes: upper bound for the size of the cache on disk (see disk_size)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+        # NOTE: The slices on disk are kept in LRU order (least recently used first) with their sizes in memory,
+        # such that eviction does not need to list the directory
+        self.__lru = collections.OrderedDict()
+        entries = []
+        for path in self.__entries():
+            try:
+                entries.append((os.path.getmtime(path), path, self.disk_size(path)))
+            except OSError:
+                pass
+        for _, path, size in sorted(entries):
+            self.__lru[path] = size
+        self.__size = sum(self.__lru.values())
+
+
+    @staticmethod
+    def key(filename, variable, index):
+        """Unique key for the slice of variable in filename"""
+        if not isinstance(index, tuple):
+            index = (index,)
+        parts = [filename, variable]
+        for i in index:
+            if isinstance(i, slice):
+                parts.append(str(i.start) + ":" + str(i.stop) + ":" + str(i.step))
+            elif np.ndim(i) > 0:
+                parts.append(",".join(str(int(j)) for j in i))
+            else:
+                parts.append(str(int(i)))
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+    def read(self, filename, variable, index, fetch):
+        """Returns the slice of variable in filename from the cache,
+        if it is not cached yet it is fetched by fetch() and stored"""
+        data = self.get(filename, variable, index)
+        if data is None:
+            data = np.asarray(fetch())
+            self.put(filename, variable, index, data)
+        return data
+
+
+    def get(self, filename, variable, index):
+        """Returns the slice of variable in filename from the cache (or None if it is not cached)"""
+        path = self.__path(filename, variable, index)
+
+        try:
+            data = np.load(path, allow_pickle=False)
+            # NOTE: The modification time marks the last access (for the LRU order of later sessions)
+            os.utime(path)
+            with self.__lock:
+                self.hits += 1
+                known = path in self.__lru
+                if known:
+                    self.__lru.move_to_end(path)
+            if not known:
+                # NOTE: The slice was stored by another process
+                size = self.disk_size(path)
+                with self.__lock:
+                    self.__size += size - self.__lru.pop(path, 0)
+                    self.__lru[path] = size
+            Instrumentation.default().count("thredds_cache.hits")
+            return data
+        except (OSError, ValueError):
+            pass
+
+        with self.__lock:
+            self.misses += 1
+        Instrumentation.default().count("thredds_cache.misses")
+        return None
+
+
+    def put(self, filename, variable, index, data):
+        """Stores the slice of variable in filename"""
+        self.__store(self.__path(filename, variable, index), np.asarray(data))
+
+
+    def hit_rate(self):
+        with self.__lock:
+            if self.hits + self.misses == 0:
+                return 0.0
+            return self.hits/(self.hits + self.misses)
+
+
+    def stats(self):
+        return "Cache hits: " + str(self.hits) + ", misses: " + str(self.misses) \
+            + ", hit rate: " + "{:.1%}".format(self.hit_rate()) + ", size: " + str(self.__size) + " bytes"
+
+
+    def evict(self):
+        """Removes the least recently used slices until the cache fits into max_bytes"""
+        with self.__lock:
+            while self.__size > self.max_bytes and len(self.__lru) > 0:
+                path, size = self.__lru.popitem(last=False)
+                self.__size -= size
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+    def __store(self, path, data):
+        # NOTE: Writing to a temporary file first such that
+        # concurrent readers never see partially written slices
+        with ThreddsUtils.atomic_path(path) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                np.save(f, data, allow_pickle=False)
+
+        size = self.disk_size(path)
+        with self.__lock:
+            self.__size += size - self.__lru.pop(path, 0)
+            self.__lru[path] = size
+        self.evict()
+
+
+    @staticmethod
+    def disk_size(path, block_size=4096):
+        """Space of the file on disk: the allocated blocks 
+        (or the size rounded up to whole blocks of block_size where the blocks are not known, like on Windows)"""
+        st = os.stat(path)
+        blocks = getattr(st, "st_blocks", None)
+        if blocks is not None:
+            return blocks*512
+        return -(-st.st_size//block_size)*block_size
+
+
+    def __path(self, filename, variable, index):
+        return os.path.join(self.cache_dir, self.key(filename, variable, index) + ".npy")
+
+
+    def __entries(self):
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".npy")]
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""Availability manifest for the files on the MET THREDDS server (thredds.met.no)
+
+For some days (or hours) there do not exist files in the THREDDS catalog.
+Instead of probing every file with netCDF4.Dataset, the THREDDS catalog (catalog.xml)
+of the directory of the files is parsed once and cached locally for `ttl` seconds.
+The importers then only get the files that exist.
+If a catalog cannot be fetched (server error or no connection) its files are not filtered
+(and the importers probe them as before), a missing catalog directory is only cached for `negative_ttl` seconds.
+
+For local copies of the files a catalog.xml (with the same structure) is read next to the files,
+without one the local files are not filtered.
+
+Test:
+'python3 ThreddsManifest.py -catalog https://thredds.met.no/thredds/catalog/fou-hi/norkyst800m-1h/catalog.xml'
+
+"""
+
+import argparse
+import sys
+import os
+import json
+import time
+import hashlib
+import threading
+from traceback import format_exc
+import xml.etree.ElementTree as ET
+import requests
+import numpy as np
+
+import HttpClient
+import IOArchive
+import Instrumentation
+import ThreddsUtils
+
+
+class ThreddsManifest:
+    def __init__(self, cache_dir=os.path.join("cache", "manifest"), ttl=24*3600, negative_ttl=3600):
+        """ Initialisation of ThreddsManifest Class
+        cache_dir: directory where the parsed catalogs are stored
+        ttl: time in seconds after which a catalog is fetched again
+        negative_ttl: time in seconds after which a missing (or empty) catalog is fetched again
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # parsed catalogs of this session
+        self.__catalogs = {}
+        self.__lock = threading.Lock()
+
+
+    @staticmethod
+    def catalog_url(filename):
+        """The catalog.xml listing the file
+        (https://thredds.met.no/thredds/dodsC/<dir>/<file> is listed in https://thredds.met.no/thredds/catalog/<dir>/catalog.xml)"""
+        directory = filename.rsplit("/", 1)[0]
+        return directory.replace("/thredds/dodsC/", "/thredds/catalog/") + "/catalog.xml"
+
+
+    def available(self, catalog_url):
+        """Returns the set of file names listed in the catalog
+        (or None if the catalog could not be fetched, such that the availability is unknown)"""
+        with self.__lock:
+            if catalog_url in self.__catalogs:
+                return self.__catalogs[catalog_url]
+
+        path = os.path.join(self.cache_dir, hashlib.sha1(catalog_url.encode("utf-8")).hexdigest() + ".json")
+        datasets = None
+        # NOTE: With an active IOArchive the catalog is always requested (and recorded or replayed)
+        if IOArchive.default() is None:
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+                ttl = self.ttl if len(manifest["datasets"]) > 0 else self.negative_ttl
+                if time.time() - manifest["fetched"] < ttl:
+                    datasets = set(manifest["datasets"])
+            except (OSError, ValueError, KeyError):
+                pass
+
+        if datasets is None:
+            datasets = self.__fetch(catalog_url)
+            if datasets is None:
+                # NOTE: An unknown availability is neither stored nor kept for the session
+                return None
+            with ThreddsUtils.atomic_path(path) as tmp_path:
+                with open(tmp_path, "w") as f:
+                    json.dump({"catalog": catalog_url, "fetched": time.time(), "datasets": sorted(datasets)}, f)
+
+        with self.__lock:
+            self.__catalogs[catalog_url] = datasets
+
+        return datasets
+
+
+    def filter(self, filenames):
+        """Returns only those filenames that are listed in their catalogs
+        (all filenames of catalogs that could not be fetched are kept)"""
+        catalogs = {}
+        existing = []
+        for filename in filenames:
+            catalog_url = self.catalog_url(filename)
+            if catalog_url not in catalogs:
+                catalogs[catalog_url] = self.available(catalog_url)
+            datasets = catalogs[catalog_url]
+            if datasets is None or filename.rsplit("/", 1)[-1] in datasets:
+                existing.append(filename)
+        return existing
+
+
+    @staticmethod
+    def __fetch(catalog_url):
+        """The set of file names in the catalog (None if it could not be fetched)"""
+        if catalog_url.startswith("http"):
+            try:
+                r = HttpClient.default().get(catalog_url)
+            except requests.exceptions.RequestException as err:
+                ThreddsManifest.__log("The catalog " + catalog_url + " could not be fetched: " + repr(err))
+                return None
+            if r.status_code == 404:
+                # the directory does not exist at all
+                return set()
+            if r.status_code != 200:
+                ThreddsManifest.__log("The catalog " + catalog_url + " could not be fetched: HTTP " + str(r.status_code))
+                return None
+            content = r.content
+        else:
+            # NOTE: Local catalogs are recorded and replayed by an active IOArchive as well
+            archive = IOArchive.default()
+            if archive is not None:
+                catalog = archive.arrays(catalog_url, "catalog", (), lambda: ThreddsManifest.__read(catalog_url))
+            else:
+                catalog = ThreddsManifest.__read(catalog_url)
+            if not catalog["exists"]:
+                # NOTE: A plain local mirror without catalog, its availability is unknown
+                return None
+            content = catalog["content"].tobytes()
+
+        try:
+            root = ET.fromstring(content)
+        except ET.ParseError as err:
+            ThreddsManifest.__log("The catalog " + catalog_url + " could not be parsed: " + repr(err))
+            return None
+
+        datasets = set()
+        for element in root.iter():
+            # NOTE: The elements are namespaced ({http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0}dataset)
+            if element.tag.endswith("dataset") and "urlPath" in element.attrib:
+                datasets.add(element.attrib["urlPath"].rsplit("/", 1)[-1])
+
+        return datasets
+
+
+    @staticmethod
+    def __read(path):
+        """The content of the local catalog as arrays (see IOArchive.arrays)"""
+        if not os.path.exists(path):
+            return {"exists": np.array(False), "content": np.zeros(0, dtype=np.uint8)}
+        with open(path, "rb") as f:
+            return {"exists": np.array(True), "content": np.frombuffer(f.read(), dtype=np.uint8)}
+
+
+    @staticmethod
+    def __log(msg):
+        Instrumentation.default().log(msg, "ThreddsManifest")
+
+
+    @staticmethod
+    def __parse_args():
+        parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument(
+            '-catalog', required=True,
+            help='url (or local path) of the catalog.xml')
+        res = parser.parse_args(sys.argv[1:])
+        return res.catalog
+
+
+    @staticmethod
+    def main():
+        catalog_url = ThreddsManifest.__parse_args()
+        datasets = ThreddsManifest().available(catalog_url)
+        if datasets is None:
+            raise Exception("The catalog " + catalog_url + " could not be fetched")
+        for dataset in sorted(datasets):
+            print(dataset)
+
+
+if __name__ == "__main__":
+
+    try:
+        ThreddsManifest.main()
+    except SystemExit as e:
+        if e.code != 0:
+            print('SystemExit(code={}): {}'.format(e.code, format_exc()), file=sys.stderr)
+            sys.exit(e.code)
+    except: # pylint: disable=bare-except
+        print('error: {}'.format(format_exc()), file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+"""Utilities shared by the importers for the MET THREDDS server (NorKystImporter and PPImporter)
+
+All reads from the netCDF files go through read_slice, read_ndim, read_times, read_files and probe,
+such that they are recorded and replayed if an IOArchive is active.
+read_files reads the same slices from many files, with several workers the files are read in worker processes
+(each with its own netCDF-C library, see NETCDF_LOCK), such that the latency of the remote reads overlaps.
+Besides, utc converts times to UTC timestamps and atomic_path writes files atomically (for all modules).
+
+"""
+
+import re
+import os
+import contextlib
+import threading
+import multiprocessing
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import netCDF4
+import numpy as np
+import pandas as pd
+
+import Instrumentation
+import IOArchive
+
+
+# nanoseconds per unit of the CF time units
+UNITS_NS = {"days": 86400*10**9, "day": 86400*10**9, "d": 86400*10**9,
+            "hours": 3600*10**9, "hour": 3600*10**9, "hrs": 3600*10**9, "hr": 3600*10**9, "h": 3600*10**9,
+            "minutes": 60*10**9, "minute": 60*10**9, "mins": 60*10**9, "min": 60*10**9,
+            "seconds": 10**9, "second": 10**9, "secs": 10**9, "sec": 10**9, "s": 10**9,
+            "milliseconds": 10**6, "millisecond": 10**6, "msec": 10**6, "ms": 10**6,
+            "microseconds": 10**3, "microsecond": 10**3, "usec": 10**3, "us": 10**3}
+
+# calendars that agree with numpy/pandas datetime arithmetic (for the times in question)
+STANDARD_CALENDARS = ["standard", "gregorian", "proleptic_gregorian"]
+
+
+def decode_times(time_var, index=slice(None)):
+    """Converts the netCDF time variable (for the given index) 
+    into a tz-aware (UTC) pandas DatetimeIndex"""
+    values = np.ma.filled(time_var[index], np.nan).astype("float64")
+    calendar = getattr(time_var, "calendar", "standard")
+    return decode_time_values(values, time_var.units, calendar)
+
+
+def decode_time_values(values, units, calendar="standard"):
+    """Converts numeric time values with CF units (like "seconds since 1970-01-01 00:00:00") 
+    into a tz-aware (UTC) pandas DatetimeIndex.
+    For the standard calendars this is pure vectorized arithmetic, 
+    other calendars are decoded by cftime"""
+    values = np.atleast_1d(np.asarray(values, dtype="float64"))
+
+    if calendar.lower() in STANDARD_CALENDARS:
+        match = re.match(r"\s*(\w+)\s+since\s+(.+)", units)
+        try:
+            unit_ns = UNITS_NS[match.group(1).lower()]
+            epoch = pd.Timestamp(match.group(2).strip())
+        except:
+            unit_ns = None
+
+        if unit_ns is not None:
+            if epoch.tzinfo is None:
+                epoch = epoch.tz_localize("UTC")
+            ns = epoch.value + np.round(values*unit_ns).astype("int64")
+            return pd.DatetimeIndex(pd.to_datetime(ns, unit="ns", utc=True))
+
+    # NOTE: Fallback for non-standard calendars (and unusual units)
+    cftimes = netCDF4.num2date(values, units, calendar)
+    return pd.DatetimeIndex([t.isoformat() for t in cftimes]).tz_localize("UTC")
+
+
+def start_index(times, start_time):
+    """Index of the last time in times before start_time (or 0) 
+    such that the time series starts with the first available time step before start_time"""
+    return max(0, int(times.searchsorted(utc(start_time), side="left")) - 1)
+
+
+def end_index(times, end_time):
+    """Index after the first time in times after end_time (or len(times)) 
+    such that times[:end_index] ends with the first available time step after end_time"""
+    return int(times.searchsorted(utc(end_time), side="right"))
+
+
+def utc(t):
+    """The time t (naive times are taken as UTC) as tz-aware UTC timestamp (None stays None)"""
+    if t is None:
+        return None
+    t = pd.Timestamp(t)
+    if t.tzinfo is None:
+        return t.tz_localize("UTC")
+    return t.tz_convert("UTC")
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Context manager giving a temporary path to write to, which replaces path at the end
+    (it is removed if the writing fails), such that concurrent readers and interrupted writes 
+    never leave a partially written file at path"""
+    tmp_path = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# NOTE: The netCDF-C library (and HDF5 below it) is not thread-safe (and netCDF4 releases the GIL).
+# All calls into it within a process - opening files and reading from local and remote (OPeNDAP) files - 
+# are serialised with this lock, thus threads never overlap netCDF reads.
+# Concurrent reads of many files run in worker processes instead (see read_files)
+NETCDF_LOCK = threading.RLock()
+
+
+class LazyDataset:
+    """netCDF file that is only opened when one of its variables is accessed the first time
+    (such that files are not opened at all if all slices are found in the cache)"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.__nc = None
+        self.lock = NETCDF_LOCK
+
+    @property
+    def variables(self):
+        if self.__nc is None:
+            with NETCDF_LOCK:
+                self.__nc = netCDF4.Dataset(self.filename)
+            Instrumentation.default().count("netcdf.opens")
+        return self.__nc.variables
+
+    def __getitem__(self, variable):
+        return self.variables[variable]
+
+    def close(self):
+        # NOTE: The file is closed explicitly under the lock
+        # (a Dataset that is left to the garbage collector is closed in whatever thread collects it)
+        with NETCDF_LOCK:
+            if self.__nc is not None:
+                self.__nc.close()
+                self.__nc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_slice(nc, variable, index, cache=None):
+    """Reads nc[variable][index] as numpy array (masked values are filled with NaN)
+    through the ThreddsCache (if given)"""
+    def fetch():
+        with nc.lock:
+            data = _filled(nc[variable][index])
+        Instrumentation.default().count("netcdf.bytes", data.nbytes)
+        return data
+
+    def read():
+        if cache is None:
+            return np.asarray(fetch())
+        return cache.read(nc.filename, variable, index, fetch)
+
+    return _archived(nc.filename, variable, index, read)
+
+
+def read_ndim(nc, variable, cache=None):
+    """Number of dimensions of nc[variable] 
+    through the ThreddsCache (if given)"""
+    def fetch():
+        with nc.lock:
+            return np.array(len(nc[variable].dimensions))
+
+    def read():
+        if cache is None:
+            return fetch()
+        return cache.read(nc.filename, variable + ".ndim", (), fetch)
+
+    return int(_archived(nc.filename, variable + ".ndim", (), read))
+
+
+def read_times(nc, index=slice(None), cache=None):
+    """Reads and decodes nc["time"][index] (see decode_times) 
+    through the ThreddsCache (if given)"""
+    def fetch():
+        with nc.lock:
+            return decode_times(nc["time"], index).asi8
+
+    def read():
+        if cache is None:
+            return fetch()
+        return cache.read(nc.filename, "time", index, fetch)
+
+    return pd.DatetimeIndex(pd.to_datetime(_archived(nc.filename, "time", index, read), unit="ns", utc=True))
+
+
+def probe(filename):
+    """Whether the netCDF file can be opened"""
+    def read():
+        try:
+            with NETCDF_LOCK:
+                netCDF4.Dataset(filename).close()
+            Instrumentation.default().count("netcdf.opens")
+            return np.array(True)
+        except Exception:
+            return np.array(False)
+
+    return bool(_archived(filename, "exists", (), read))
+
+
+def _archived(filename, variable, index, read):
+    """read() through the active IOArchive (if any)"""
+    archive = IOArchive.default()
+    if archive is None:
+        return read()
+    return archive.array(filename, variable, index, read)
+
+
+def assemble(chunks):
+    """Builds one data frame from a list of chunks (one per file), 
+    where a chunk is a dict of 1-d arrays (column name: values) with the times in "referenceTime" as int64 nanoseconds.
+    The columns are copied into arrays that are allocated only once"""
+    n = sum(len(chunk["referenceTime"]) for chunk in chunks)
+
+    columns = {}
+    for name in chunks[0].keys():
+        dtype = np.result_type(*[np.asarray(chunk[name]).dtype for chunk in chunks])
+        columns[name] = np.empty(n, dtype=dtype)
+
+    i = 0
+    for chunk in chunks:
+        m = len(chunk["referenceTime"])
+        for name in columns.keys():
+            columns[name][i:i+m] = chunk[name]
+        i += m
+
+    #NOTE: Since the other data sources explicitly specify the time zone
+    # the times are tz-aware (UTC) datetimes
+    columns["referenceTime"] = pd.to_datetime(columns["referenceTime"], unit="ns", utc=True)
+
+    return pd.DataFrame(columns)
+
+
+def read_files(filenames, reads, workers=1, cache=None):
+    """Reads the slices `reads` (list of (variable, index), "time" is decoded as in read_times) from every file
+    through the ThreddsCache (if given), a file is only opened if some of its slices are not cached.
+    With workers > 1 the files are opened and read in up to `workers` worker processes
+    (which are started from a fresh process, thus scripts need the usual `if __name__ == "__main__":` guard).
+    Returns per file the list of arrays (in the order of reads, None for files that could not be read)
+    and the list of failures as (filename, error message) - both in the order of filenames"""
+    results = [None]*len(filenames)
+    errors = {}
+
+    # slices that have to be read per file
+    missing = {}
+    for i in range(len(filenames)):
+        try:
+            results[i] = [_lookup(filenames[i], variable, index, cache) for variable, index in reads]
+        except Exception as err:
+            errors[i] = repr(err)
+            continue
+        todo = [j for j in range(len(reads)) if results[i][j] is None]
+        if len(todo) > 0:
+            missing[i] = todo
+
+    def done(i, arrays):
+        for j, data in zip(missing[i], arrays):
+            results[i][j] = data
+        Instrumentation.default().count("netcdf.opens")
+        Instrumentation.default().count("netcdf.bytes", sum(data.nbytes for data in arrays))
+
+    items = list(missing.keys())
+    if workers is None or workers <= 1 or len(items) <= 1:
+        for i in items:
+            try:
+                done(i, _read1file(filenames[i], [reads[j] for j in missing[i]]))
+            except Exception as err:
+                errors[i] = repr(err)
+    else:
+        executor = _executor(workers)
+        futures = {executor.submit(_read1file, filenames[i], [reads[j] for j in missing[i]]): i for i in items}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                done(i, future.result())
+            except BrokenProcessPool as err:
+                _discard(executor)
+                errors[i] = repr(err)
+            except Exception as err:
+                errors[i] = repr(err)
+
+    for i in range(len(filenames)):
+        if i in errors:
+            results[i] = None
+            continue
+        for j in range(len(reads)):
+            variable, index = reads[j]
+            _keep(filenames[i], variable, index, results[i][j], cache, j in missing.get(i, []))
+            if variable == "time":
+                results[i][j] = pd.DatetimeIndex(pd.to_datetime(results[i][j], unit="ns", utc=True))
+
+    failures = [(filenames[i], errors[i]) for i in sorted(errors.keys())]
+
+    return results, failures
+
+
+# worker processes of read_files by number of workers
+_executors = {}
+_executors_lock = threading.Lock()
+
+def _executor(workers):
+    """The pool of worker processes for read_files 
+    (kept for the whole session, such that the workers are only started once)"""
+    with _executors_lock:
+        if workers not in _executors:
+            # NOTE: The workers are not forked from this process, 
+            # such that they never inherit the state of a netCDF-C library that another thread is using.
+            # With a fork server (not on Windows) the modules are imported only once (in the server) 
+            # and the workers are forked from the server, otherwise every worker is spawned
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["__main__", __name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            if len(_executors) == 0:
+                # NOTE: Processes of multiprocessing (like the workers of run_download) join their children at exit,
+                # the pools are shut down before (finalizers with exit priority run first), otherwise the exit hangs.
+                # The priority is above the one of the queues of the pools (10), which have to be open for the shutdown
+                multiprocessing.util.Finalize(None, _shutdown, exitpriority=20)
+            _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        return _executors[workers]
+
+
+def _shutdown():
+    """Shuts down all pools of read_files (at exit)"""
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+
+def _discard(executor):
+    """Drops a broken pool (a worker died), such that the next read_files starts a new one"""
+    with _executors_lock:
+        for workers in [w for w, e in _executors.items() if e is executor]:
+            del _executors[workers]
+    executor.shutdown(wait=False)
+
+
+def _read1file(filename, reads):
+    """Opens filename once and reads the slices (variable, index) from it
+    (in a worker process of read_files or under NETCDF_LOCK)"""
+    with NETCDF_LOCK:
+        nc = netCDF4.Dataset(filename)
+        try:
+            arrays = []
+            for variable, index in reads:
+                if variable == "time":
+                    arrays.append(decode_times(nc["time"], index).asi8)
+                else:
+                    arrays.append(_filled(nc[variable][index]))
+        finally:
+            nc.close()
+    return arrays
+
+
+def _filled(data):
+    """The array read from a netCDF variable with masked values filled with NaN"""
+    if np.ma.isMaskedArray(data):
+        data = np.ma.filled(data.astype(np.result_type(data.dtype, np.float32)), np.nan)
+    return np.asarray(data)
+
+
+def _lookup(filename, variable, index, cache):
+    """The slice from the IOArchive (in replay mode) or from the cache (None if it has to be read)"""
+    archive = IOArchive.default()
+    if archive is not None and archive.mode == "replay":
+        return archive.array(filename, variable, index, None)
+    if cache is not None:
+        return cache.get(filename, variable, index)
+    return None
+
+
+def _keep(filename, variable, index, data, cache, fetched):
+    """Stores a slice that was read in the cache and records every slice in the IOArchive (in record mode)"""
+    if fetched and cache is not None:
+        cache.put(filename, variable, index, data)
+    archive = IOArchive.default()
+    if archive is not None and archive.mode == "record":
+        archive.array(filename, variable, index, lambda: data)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""Alignment of the time series of all sources on one master time index
+
+The master index (the hourly times of the dataset) is set up once,
+every source writes its values directly into column arrays at the positions of its times in the master index
+(found with one vectorized lookup per source), and the data frame is built only once in the end.
+Thus the wide dataset is not copied for every source (or Frost station) that is added.
+
+Per source the times can be matched
+- exactly (default)
+- with the nearest or the last earlier observation ("nearest" or "pad") at most `tolerance` away
+Only observed (non-missing) values are written, such that values written before are kept where a source has no observation.
+
+Usage (see DataImporter.constructDataset):
+'aligner = TimeAligner.TimeAligner(times)'
+'aligner.add(timeseries, ["water_temp"], time_col="time")'
+'aligner.add(frost_timeseries, ["air_temperature"], "referenceTime", names=["SN18700air_temperature0"], method="nearest")'
+'data = aligner.frame()'
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import ThreddsUtils
+
+
+METHODS = [None, "nearest", "pad"]
+
+
+class TimeAligner:
+    def __init__(self, times, data=None):
+        """ Initialisation of TimeAligner Class
+        times: master time index (tz-aware UTC, sorted and unique)
+        data: optional data frame indexed by (a subset of) times whose columns are taken over first
+        """
+        self.times = pd.DatetimeIndex(times, name="time")
+        # column arrays (in the order the columns are added)
+        self.columns = {}
+
+        if data is not None:
+            self.add(data, list(data.columns), time_col=None)
+
+
+    def add(self, timeseries, columns, time_col="time", names=None, method=None, tolerance=None,
+            start_time=None, end_time=None):
+        """Writes the values of `columns` of timeseries (with the times in the column time_col
+        or in the index if time_col is None) at the matching master times.
+        names: column names in the dataset (default: as in timeseries)
+        method, tolerance: matching of the times (see above)
+        start_time, end_time: only master times within [start_time, end_time] are written (None for no limit)
+        Returns the boolean mask (over the master times) where values of timeseries are used"""
+        if names is None:
+            names = list(columns)
+
+        if time_col is None:
+            source = pd.DatetimeIndex(timeseries.index)
+        else:
+            source = pd.DatetimeIndex(timeseries[time_col])
+
+        # NOTE: The lookups need sorted and unique times (the first observation of a time is kept)
+        order = None
+        if not source.is_monotonic_increasing or not source.is_unique:
+            order = np.argsort(source.asi8, kind="stable")
+            order = order[~source[order].duplicated()]
+            source = source[order]
+
+        indexer = source.get_indexer(self.times, method=method, tolerance=tolerance)
+        if order is not None:
+            indexer = np.where(indexer >= 0, order[np.maximum(indexer, 0)], -1)
+
+        found = indexer >= 0
+        if start_time is not None:
+            found &= self.times >= ThreddsUtils.utc(start_time)
+        if end_time is not None:
+            found &= self.times <= ThreddsUtils.utc(end_time)
+        positions = np.flatnonzero(found)
+        rows = indexer[positions]
+
+        for column, name in zip(columns, names):
+            values = np.asarray(timeseries[column].values)[rows]
+            target = self.__column(name, values.dtype)
+            observed = ~pd.isna(values)
+            target[positions[observed]] = values[observed]
+
+        return found
+
+
+    def __column(self, name, dtype):
+        """The array of column `name` (allocated on first use, missing values are NaN)"""
+        if name not in self.columns:
+            if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+                self.columns[name] = np.full(len(self.times), np.nan, dtype=np.result_type(dtype, np.float32))
+            else:
+                self.columns[name] = np.full(len(self.times), np.nan, dtype=object)
+        return self.columns[name]
+
+
+    def frame(self):
+        """The data frame indexed by the master times with all columns
+        (the column arrays are released, such that only one copy of the dataset is kept)"""
+        data = pd.DataFrame(self.columns, index=self.times)
+        self.columns = {}
+        return data
+
@@ -0,0 +1,174 @@
+"""
+Local stand-in for the Frost (frost.met.no) and Havvarsel Frost (havvarsel-frost.met.no) APIs
+
+Serves the endpoints used by FrostImporter, FrostStationCatalog and HavvarselFrostImporter
+with synthetic (but realistically sized) payloads:
+- /sources/v0.jsonld
+- /observations/availableTimeSeries/v0.jsonld
+- /observations/v0.csv (the observations start at first_time, as Frost it answers 412 both
+  for windows without any observations and for requests above the observation limit)
+- /api/v1/obs/badevann/get
+
+Usage:
+'server = mock_server.MockServer(); server.start(); print(server.url); ...; server.stop()'
+'python benchmarks/mock_server.py -port 8080'
+"""
+
+import argparse
+import sys
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+
+
+# time resolution of the elements in the synthetic Frost database
+RESOLUTIONS = {"air_temperature": "PT10M", "wind_speed": "PT10M"}
+DEFAULT_RESOLUTION = "PT1H"
+
+OBSERVATION_LIMIT = 100000
+
+
+def _time_range(value):
+    start, end = value.split("/")
+    return pd.Timestamp(start.replace("Z", "")), pd.Timestamp(end.replace("Z", ""))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.count(url.path)
+
+        if url.path == "/sources/v0.jsonld":
+            self.__json({"data": self.server.sources})
+        elif url.path == "/observations/availableTimeSeries/v0.jsonld":
+            self.__available(query)
+        elif url.path == "/observations/v0.csv":
+            self.__observations(query)
+        elif url.path == "/api/v1/obs/badevann/get":
+            self.__badevann(query)
+        else:
+            self.__send(404, b"not found", "text/plain")
+
+    def __available(self, query):
+        if "sources" in query:
+            sources = query["sources"].split(",")
+        else:
+            sources = [source["id"] for source in self.server.sources]
+        data = []
+        for source in sources:
+            for element in query.get("elements", "").split(","):
+                data.append({"sourceId": source + ":0", "elementId": element,
+                             "timeResolution": RESOLUTIONS.get(element, DEFAULT_RESOLUTION)})
+        self.__json({"data": data})
+
+    def __observations(self, query):
+        start, end = _time_range(query["referencetime"])
+        sources = query["sources"].split(",")
+        elements = query["elements"].split(",")
+
+        step = "10min" if any(RESOLUTIONS.get(e, DEFAULT_RESOLUTION) == "PT10M" for e in elements) else "H"
+        times = pd.date_range(start, end, freq=step)
+        times = times[(times < end) & (times >= self.server.first_time)]
+        if len(times) == 0:
+            self.__json({"error": {"code": 412, "message": "No data found",
+                                   "reason": "No time series were found for the query"}}, 412)
+            return
+        if len(times)*len(sources) > OBSERVATION_LIMIT:
+            self.__json({"error": {"code": 412, "message": "Precondition failed",
+                                   "reason": "The request exceeds the observation limit of " + str(OBSERVATION_LIMIT)}}, 412)
+            return
+
+        rng = np.random.default_rng(len(times))
+        frames = []
+        for source in sources:
+            frame = pd.DataFrame({"sourceId": source + ":0",
+                                  "referenceTime": times.strftime("%Y-%m-%dT%H:%M:%S.000Z")})
+            for element in elements:
+                values = np.round(10 + rng.standard_normal(len(times)), 1)
+                if RESOLUTIONS.get(element, DEFAULT_RESOLUTION) == "PT1H" and step != "H":
+                    values[times.minute != 0] = np.nan
+                frame[element] = values
+            frames.append(frame)
+        self.__send(200, pd.concat(frames).to_csv(index=False).encode("utf-8"), "text/csv")
+
+    def __badevann(self, query):
+        start, end = _time_range(query["time"])
+        times = pd.date_range(start, end, freq="H") + pd.Timedelta(minutes=1)
+        rng = np.random.default_rng(len(times))
+        tseries = []
+        for buoyid in query["buoyids"].split(","):
+            values = np.round(15 + rng.standard_normal(len(times)), 2)
+            tseries.append({"header": {"id": {"buoyid": buoyid, "parameter": query.get("parameter", "temperature")},
+                                       "extra": {"name": "Buoy " + buoyid,
+                                                 "pos": {"lon": str(self.server.lon), "lat": str(self.server.lat)}}},
+                            "observations": [{"time": t, "body": {"value": str(v)}}
+                                             for t, v in zip(times.strftime("%Y-%m-%dT%H:%M:%SZ"), values)]})
+        self.__json({"data": {"tseries": tseries}})
+
+    def __json(self, content, status=200):
+        self.__send(status, json.dumps(content).encode("utf-8"), "application/json")
+
+    def __send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, lon=10.7, lat=59.9, n_sources=300, first_time="2021-01-01"):
+        """ Initialisation of MockServer Class
+        port: port to listen on (0 for any free port)
+        lon, lat: location of the buoys, the Frost sources are spread around it
+        n_sources: number of Frost sources
+        first_time: time of the first Frost observation (earlier windows are empty)
+        """
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.lon, self.lat = lon, lat
+        self.first_time = pd.Timestamp(first_time)
+        rng = np.random.default_rng(2)
+        self.sources = [{"@type": "SensorSystem", "id": "SN" + str(10000 + i), "name": "STATION " + str(i),
+                         "geometry": {"@type": "Point", "coordinates": [lon + rng.uniform(-3, 3), lat + rng.uniform(-1.5, 1.5)],
+                                      "nearest": False}}
+                        for i in range(n_sources)]
+        self.requests = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def count(self, path):
+        with self.__lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-port', type=int, default=8080, help='port to listen on')
+    args = parser.parse_args(sys.argv[1:])
+    server = MockServer(args.port)
+    print("Serving on " + server.url)
+    server.serve_forever()
@@ -0,0 +1,220 @@
+"""
+Offline benchmarks of the importers
+
+The THREDDS files are replaced by synthetic local files (see synthetic_data.py),
+Frost and Havvarsel Frost by a local mock server (see mock_server.py).
+Every benchmark runs in a fresh process (after one warm-up run that builds the grid indices and catalogs)
+and is measured for
+- wall time (best of the repetitions)
+- peak memory (maximal resident set size of the worker process, including the imports,
+  without the processes that read the netCDF files, see ThreddsUtils.read_files)
+- HTTP requests and netCDF opens
+The results are compared to the stored baseline (by default the committed benchmarks/baselines/reference.json):
+runs that need more requests or netCDF opens than the baseline are reported as regressions on any machine,
+runs that are slower or use more memory (plus tolerance) only if the baseline was stored on the same machine
+(store one with -save -baseline benchmarks/baselines/<name>.json).
+
+Usage:
+'python benchmarks/run_benchmarks.py'                 (compare with the baseline)
+'python benchmarks/run_benchmarks.py -save'           (store the results as new baseline)
+'python benchmarks/run_benchmarks.py -only norkyst pp -repeat 5'
+"""
+
+import argparse
+import sys
+import os
+import io
+import json
+import time
+import platform
+import datetime
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import synthetic_data
+import mock_server
+
+
+START = datetime.datetime(2021, 6, 1)
+DAYS = 7
+STATION_ID = "100"
+
+
+def bench_norkyst(env):
+    import NorKystImporter
+    importer = NorKystImporter.NorKystImporter(env["start"], env["end"], filename_format=env["norkyst"],
+                    workers=4, manifest=env["manifest"]())
+    importer.norkyst_data("temperature", synthetic_data.SITE_LON, synthetic_data.SITE_LAT, depth=[0, 3, 10])
+
+
+def bench_pp(env):
+    import PPImporter
+    importer = PPImporter.PPImporter(env["start"], env["end"], archive_url=env["pp"], workers=4, manifest=env["manifest"]())
+    importer.pp_data(synthetic_data.PP_PARAMS, synthetic_data.SITE_LON, synthetic_data.SITE_LAT, env["start"], env["end"])
+
+
+def bench_frost(env):
+    import pandas as pd
+    import FrostImporter
+    importer = FrostImporter.FrostImporter(start_time=env["start"], end_time=env["end"], frost_api_base=env["url"])
+    location = pd.DataFrame({"lon": [synthetic_data.SITE_LON], "lat": [synthetic_data.SITE_LAT]})
+    station_ids = list(importer.location_ids(location, 4, "air_temperature"))
+    importer.data(station_ids[0], "air_temperature")
+    # NOTE: A year without observations (a single request that is answered with 412)
+    importer.data(station_ids[0], "air_temperature", env["start"] - datetime.timedelta(days=2*365), env["start"] - datetime.timedelta(days=365))
+    importer.data_matrix(station_ids, ["air_temperature", "wind_speed", "cloud_area_fraction"])
+
+
+def bench_havvarsel(env):
+    import HavvarselFrostImporter
+    importer = HavvarselFrostImporter.HavvarselFrostImporter(env["start"], env["end"])
+    importer.data(STATION_ID, frost_api_base=env["url"])
+    importer.data_multi([str(i) for i in range(20)], frost_api_base=env["url"])
+
+
+def bench_dataset(env):
+    import DataImporter
+    dataImporter = DataImporter.DataImporter(start_time=env["start"].strftime("%Y-%m-%dT%H:%M"),
+                        end_time=env["end"].strftime("%Y-%m-%dT%H:%M"))
+    dataImporter.havvarsel_api_base = env["url"]
+    dataImporter.frost_api_base = env["url"]
+    dataImporter.norkyst_filename_format = env["norkyst"]
+    dataImporter.pp_archive_url = env["pp"]
+    dataImporter.constructDataset(STATION_ID)
+
+
+BENCHMARKS = {"norkyst": bench_norkyst, "pp": bench_pp, "frost": bench_frost,
+              "havvarsel": bench_havvarsel, "dataset": bench_dataset}
+
+
+def run_once(name, env):
+    """Runs the benchmark `name` (in a fresh worker process) and returns its measurements"""
+    import ThreddsManifest
+    import HttpClient
+    import Instrumentation
+
+    os.chdir(env["workdir"])
+    env = dict(env)
+    env["manifest"] = ThreddsManifest.ThreddsManifest
+
+    tic = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        BENCHMARKS[name](env)
+        Instrumentation.default().flush()
+    seconds = time.perf_counter() - tic
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    http = HttpClient.default().stats
+    counters = Instrumentation.default().counters
+    # NOTE: ru_maxrss is given in kilobytes on Linux (and in bytes on macOS)
+    scale = 1024**2 if platform.system() == "Darwin" else 1024
+    return {"seconds": seconds,
+            "peak_mb": rss/scale,
+            "requests": sum(stats["requests"] for stats in http.values()),
+            "http_bytes": sum(stats["bytes"] for stats in http.values()),
+            "netcdf_opens": counters.get("netcdf.opens", 0)}
+
+
+def run(name, env, repeat):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    # NOTE: The first run builds the grid indices and catalogs in the work directory and is not measured.
+    # A crashing worker raises BrokenProcessPool (instead of blocking)
+    for i in range(repeat + 1):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_once, name, env).result()
+        if i > 0:
+            results.append(result)
+
+    best = min(results, key=lambda result: result["seconds"])
+    best["peak_mb"] = max(result["peak_mb"] for result in results)
+    return best
+
+
+def compare(results, baseline, tolerance, same_host=True):
+    """Lines of the report and the list of regressions
+    (times and memory are only compared with a baseline of the same machine)"""
+    lines = ["{:<10} {:>9} {:>9} {:>9} {:>12} {:>7}".format("benchmark", "seconds", "peak MB", "requests", "HTTP bytes", "opens")]
+    regressions = []
+    for name, result in results.items():
+        lines.append("{:<10} {:>9.3f} {:>9.1f} {:>9d} {:>12d} {:>7d}".format(name, result["seconds"], result["peak_mb"],
+            result["requests"], result["http_bytes"], result["netcdf_opens"]))
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if same_host and result["seconds"] > base["seconds"]*(1 + tolerance):
+            regressions.append(name + ": {:.3f} s (baseline {:.3f} s)".format(result["seconds"], base["seconds"]))
+        if same_host and result["peak_mb"] > base["peak_mb"]*(1 + tolerance):
+            regressions.append(name + ": {:.1f} MB (baseline {:.1f} MB)".format(result["peak_mb"], base["peak_mb"]))
+        for key in ["requests", "netcdf_opens"]:
+            if result[key] > base[key]:
+                regressions.append(name + ": " + str(result[key]) + " " + key + " (baseline " + str(base[key]) + ")")
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-only', nargs='+', choices=list(BENCHMARKS.keys()), default=list(BENCHMARKS.keys()),
+        help='benchmarks to run')
+    parser.add_argument('-repeat', type=int, default=5, help='number of measured runs per benchmark')
+    parser.add_argument('-data', default=os.path.join(tempfile.gettempdir(), "havvarsel_benchmark_data"),
+        help='directory for the synthetic files')
+    parser.add_argument('-baseline', default=os.path.join(BENCHMARK_DIR, "baselines", "reference.json"),
+        help='baseline file')
+    parser.add_argument('-tolerance', type=float, default=0.25, help='relative tolerance for time and memory')
+    parser.add_argument('-save', action='store_true', help='store the results as baseline')
+    args = parser.parse_args(sys.argv[1:])
+
+    print("Generating synthetic data in " + args.data)
+    norkyst, pp = synthetic_data.generate(args.data, START.date(), DAYS)
+
+    server = mock_server.MockServer(lon=synthetic_data.SITE_LON, lat=synthetic_data.SITE_LAT).start()
+    workdir = tempfile.mkdtemp(prefix="havvarsel_benchmark_")
+    env = {"start": START, "end": START + datetime.timedelta(days=DAYS) - datetime.timedelta(minutes=1),
+           "norkyst": norkyst, "pp": pp, "url": server.url, "workdir": workdir}
+
+    results = {}
+    try:
+        for name in args.only:
+            print("Running " + name + "...")
+            results[name] = run(name, env, args.repeat)
+    finally:
+        server.stop()
+
+    baseline, host = {}, None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline, host = stored["results"], stored.get("host")
+
+    lines, regressions = compare(results, baseline, args.tolerance, host == platform.node())
+    if len(baseline) > 0 and host != platform.node():
+        print("The baseline is from " + str(host) + ", only the requests and netCDF opens are compared")
+    print("\n".join(lines))
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"saved": datetime.datetime.now().isoformat(timespec="seconds"), "host": platform.node(),
+                       "python": platform.python_version(),
+                       "results": dict(baseline, **results)}, f, indent=1)
+        print("Baseline stored in " + args.baseline)
+    elif len(baseline) == 0:
+        print("No baseline found (store one with -save)")
+    elif len(regressions) > 0:
+        print("Regressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    else:
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Synthetic stand-ins for the THREDDS files used by the importers
+
+- NorKyst800 ZDEPTHS files (one file per day with hourly fields in 16 depths)
+- Post-processed analysis files met_analysis_1_0km_nordic (one file per hour)
+Both are written with the variables, dimensions and attributes the importers read,
+on small grids around the benchmark site, together with a catalog.xml per directory
+(as on thredds.met.no, see ThreddsManifest).
+
+Usage:
+'python benchmarks/synthetic_data.py -out /tmp/benchmark_data -S 2021-06-01 -days 7'
+"""
+
+import argparse
+import sys
+import os
+import datetime
+import numpy as np
+import netCDF4
+import pyproj
+
+
+# the benchmark site (a swimming site close to Oslo)
+SITE_LON, SITE_LAT = 10.7, 59.9
+
+NORKYST_DEPTHS = [0, 3, 10, 15, 25, 50, 75, 100, 150, 200, 250, 300, 500, 1000, 2000, 3000]
+NORKYST_PROJ4 = "+proj=stere +ellps=WGS84 +lat_0=90.0 +lat_ts=60.0 +x_0=3192800 +y_0=1784000 +lon_0=70"
+
+PP_PARAMS = ['air_temperature_2m', 'wind_speed_10m', 'wind_direction_10m','precipitation_amount',
+    'cloud_area_fraction', 'integral_of_surface_downwelling_shortwave_flux_in_air_wrt_time']
+PP_PROJ4 = "+proj=lcc +lat_0=63 +lon_0=15 +lat_1=63 +lat_2=63 +no_defs +R=6.371e+06"
+
+NORKYST_FORMAT = "norkyst/NorKyst-800m_ZDEPTHS_his.an.%Y%m%d00.nc"
+
+
+def grid(proj4, spacing, ny, nx):
+    """Regular grid in the projection centered at the site: x, y, lon, lat"""
+    p = pyproj.Proj(proj4)
+    x0, y0 = p(SITE_LON, SITE_LAT)
+    xs = x0 + (np.arange(nx) - nx//2)*spacing
+    ys = y0 + (np.arange(ny) - ny//2)*spacing
+    X, Y = np.meshgrid(xs, ys)
+    lon, lat = p(X, Y, inverse=True)
+    return X, Y, lon, lat
+
+
+def write_catalog(directory):
+    """catalog.xml listing all netCDF files in directory"""
+    datasets = "".join('  <dataset name="{0}" ID="{0}" urlPath="{0}"/>\n'.format(f)
+                       for f in sorted(os.listdir(directory)) if f.endswith(".nc"))
+    with open(os.path.join(directory, "catalog.xml"), "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0">\n'
+                + datasets + '</catalog>\n')
+
+
+def norkyst(out, start, days, ny=60, nx=60):
+    """Writes `days` NorKyst files from the date start, returns the filename format"""
+    directory = os.path.join(out, "norkyst")
+    os.makedirs(directory, exist_ok=True)
+    X, Y, lon, lat = grid(NORKYST_PROJ4, 800., ny, nx)
+    # NOTE: Land has the minimal depth, a strip in the west is land
+    h = np.where(np.arange(nx)[None, :] < nx//8, 5.0, 20.0 + np.arange(nx)[None, :]*np.ones((ny, 1)))
+    rng = np.random.default_rng(0)
+
+    for d in range(days):
+        day = start + datetime.timedelta(days=d)
+        nc = netCDF4.Dataset(os.path.join(out, day.strftime(NORKYST_FORMAT)), "w")
+        nc.createDimension("time", None)
+        nc.createDimension("depth", len(NORKYST_DEPTHS))
+        nc.createDimension("Y", ny)
+        nc.createDimension("X", nx)
+
+        t = nc.createVariable("time", "f8", ("time",))
+        t.units = "seconds since 1970-01-01 00:00:00"
+        t.calendar = "gregorian"
+        t[:] = (datetime.datetime(day.year, day.month, day.day) - datetime.datetime(1970, 1, 1)).total_seconds() \
+            + np.arange(24)*3600
+        nc.createVariable("depth", "f8", ("depth",))[:] = NORKYST_DEPTHS
+        nc.createVariable("polar_stereographic", "i4").proj4 = NORKYST_PROJ4
+        nc.createVariable("lat", "f8", ("Y", "X"))[:] = lat
+        nc.createVariable("lon", "f8", ("Y", "X"))[:] = lon
+        nc.createVariable("h", "f8", ("Y", "X"))[:] = h
+
+        shape = (24, len(NORKYST_DEPTHS), ny, nx)
+        nc.createVariable("temperature", "f4", ("time", "depth", "Y", "X"), fill_value=-32768.)[:] = \
+            (15 + rng.standard_normal(shape)).astype("f4")
+        nc.createVariable("salinity", "f4", ("time", "depth", "Y", "X"), fill_value=-32768.)[:] = \
+            (30 + rng.standard_normal(shape)).astype("f4")
+        nc.createVariable("zeta", "f4", ("time", "Y", "X"), fill_value=-32768.)[:] = \
+            rng.standard_normal((24, ny, nx)).astype("f4")
+        nc.close()
+
+    write_catalog(directory)
+    return os.path.join(out, NORKYST_FORMAT)
+
+
+def pp(out, start, days, ny=60, nx=60):
+    """Writes hourly PP files for `days` days from the date start, returns the archive url"""
+    X, Y, lon, lat = grid(PP_PROJ4, 1000., ny, nx)
+    rng = np.random.default_rng(1)
+    t0 = datetime.datetime(start.year, start.month, start.day)
+
+    directories = set()
+    for h in range(24*days):
+        t = t0 + datetime.timedelta(hours=h)
+        # NOTE: Files before 2020 are in metpparchivev2 (see PPImporter.pp_filenames)
+        archive = "metpparchive" if t.year >= 2020 else "metpparchivev2"
+        directory = os.path.join(out, archive, t.strftime("%Y/%m/%d"))
+        os.makedirs(directory, exist_ok=True)
+        directories.add(directory)
+
+        nc = netCDF4.Dataset(os.path.join(directory, t.strftime("met_analysis_1_0km_nordic_%Y%m%dT%HZ.nc")), "w")
+        nc.createDimension("time", 1)
+        nc.createDimension("y", ny)
+        nc.createDimension("x", nx)
+        tv = nc.createVariable("time", "f8", ("time",))
+        tv.units = "seconds since 1970-01-01 00:00:00 +00:00"
+        tv[:] = [(t - datetime.datetime(1970, 1, 1)).total_seconds()]
+        nc.createVariable("projection_lcc", "i4").proj4 = PP_PROJ4
+        nc.createVariable("latitude", "f8", ("y", "x"))[:] = lat
+        nc.createVariable("longitude", "f8", ("y", "x"))[:] = lon
+        for param in PP_PARAMS:
+            nc.createVariable(param, "f4", ("time", "y", "x"), fill_value=-32768.)[:] = \
+                rng.standard_normal((1, ny, nx)).astype("f4")
+        nc.close()
+
+    for directory in directories:
+        write_catalog(directory)
+    return out
+
+
+def generate(out, start, days):
+    """Writes all synthetic files (if they do not exist yet), returns (NorKyst filename format, PP archive url)"""
+    marker = os.path.join(out, "generated_" + start.isoformat() + "_" + str(days))
+    if not os.path.exists(marker):
+        os.makedirs(out, exist_ok=True)
+        norkyst(out, start, days)
+        pp(out, start, days)
+        open(marker, "w").close()
+    return os.path.join(out, NORKYST_FORMAT), out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-out', required=True, help='directory for the files')
+    parser.add_argument('-S', '--start-date', default="2021-06-01", help='first day (YYYY-MM-DD)')
+    parser.add_argument('-days', type=int, default=7, help='number of days')
+    args = parser.parse_args(sys.argv[1:])
+    print(generate(args.out, datetime.date.fromisoformat(args.start_date), args.days))
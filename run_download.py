@@ -1,20 +1,211 @@
 """"
 Fetching the full data sets for all available stations
+
+The stations are built in parallel processes (one DataImporter per station).
+The state of every station is kept in a ledger file, such that an interrupted run
+continues with the stations that are not finished yet when it is started again.
+Failed stations are retried (with increasing waiting time) and reported at the end.
+Stations whose dataset was written without some source (that failed or timed out) are partial,
+those are retried (and continued in later runs) like the failed ones.
+The ledger counts the attempts of all runs, the retries are counted per run
+(such that stations that failed in an earlier run get their retries again).
+
+Usage:
+'python run_download.py -workers 8 -retries 2'
 """
 
+import argparse
+import sys
+import os
+import json
+import time
+import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from traceback import format_exc
 import pandas as pd
 import DataImporter
+import ThreddsUtils
+
+
+def build_station(station_id, start_time, end_time, format):
+    """Constructs the dataset of one station (in a worker process) 
+    and returns the time it took and the failures by source (empty if the dataset is complete)"""
+    tic = time.time()
+    dataImporter = DataImporter.DataImporter(start_time=start_time, end_time=end_time, format=format, allow_partial=True)
+    failures = dataImporter.constructDataset(station_id=station_id)
+    return time.time() - tic, failures
+
+
+class Ledger:
+    """Persistent state of the jobs (one per station): pending, running, done, partial or failed"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.jobs = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.jobs = json.load(f)
+        # NOTE: Jobs that were running when the last run stopped are started again
+        for job in self.jobs.values():
+            if job["status"] == "running":
+                job["status"] = "pending"
+
+    def add(self, station_id, start_time, end_time):
+        if station_id not in self.jobs:
+            self.jobs[station_id] = {"start_time": start_time, "end_time": end_time, "status": "pending",
+                                     "attempts": 0, "seconds": None, "error": None}
+
+    def update(self, station_id, **kwargs):
+        self.jobs[station_id].update(kwargs)
+        self.save()
+
+    def save(self):
+        # NOTE: Writing to a temporary file first such that a crash never leaves a broken ledger
+        with ThreddsUtils.atomic_path(self.filename) as tmp_filename:
+            with open(tmp_filename, "w") as f:
+                json.dump(self.jobs, f, indent=1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-f', dest='filename', default="buoys-details.csv",
+        help='station information (buoyid, first_obs, last_obs, N_obs)')
+    parser.add_argument(
+        '-workers', type=int, default=os.cpu_count(),
+        help='number of stations that are built in parallel')
+    parser.add_argument(
+        '-retries', type=int, default=2,
+        help='number of retries for failed stations')
+    parser.add_argument(
+        '-backoff', type=float, default=60.0,
+        help='waiting time in seconds before the first retry (doubled for every further retry)')
+    parser.add_argument(
+        '-ledger', default="download_ledger.json",
+        help='file keeping the state of the stations between runs')
+    parser.add_argument(
+        '-format', default="csv", choices=["csv", "parquet", "feather"],
+        help='format of the dataset files')
+    return parser.parse_args(sys.argv[1:])
+
+
+def report(ledger, wall_time):
+    jobs = ledger.jobs
+    done = [station_id for station_id, job in jobs.items() if job["status"] == "done"]
+    partial = [station_id for station_id, job in jobs.items() if job["status"] == "partial"]
+    failed = [station_id for station_id, job in jobs.items() if job["status"] == "failed"]
+    seconds = sum(jobs[station_id]["seconds"] or 0.0 for station_id in done)
+
+    lines = ["-------------------------------------------",
+             "Finished at " + datetime.datetime.now().isoformat(timespec="seconds"),
+             str(len(done)) + " of " + str(len(jobs)) + " stations done, " + str(len(partial)) + " partial, " 
+                + str(len(failed)) + " failed",
+             "Wall time: {:.1f} s, time of all stations built in this run and before: {:.1f} s".format(wall_time, seconds)]
+    for station_id in sorted(done, key=lambda s: -(jobs[s]["seconds"] or 0.0)):
+        lines.append("  " + station_id + ": {:.1f} s".format(jobs[station_id]["seconds"] or 0.0)
+            + " (" + str(jobs[station_id]["attempts"]) + " attempt(s))")
+    if len(partial) > 0:
+        lines.append("Partial stations (dataset written without the failed sources):")
+        for station_id in partial:
+            lines.append("  " + station_id + " after " + str(jobs[station_id]["attempts"]) + " attempt(s): "
+                + str(jobs[station_id]["error"]))
+    if len(failed) > 0:
+        lines.append("Failed stations:")
+        for station_id in failed:
+            lines.append("  " + station_id + " after " + str(jobs[station_id]["attempts"]) + " attempt(s): "
+                + str(jobs[station_id]["error"]))
+    lines.append("-------------------------------------------")
+    return "\n".join(lines)
+
+
+def main():
+    args = parse_args()
+    tic = time.time()
+
+    # All station information
+    df = pd.read_csv(args.filename).sort_values("N_obs", ascending=False, ignore_index=True)
+
+    ledger = Ledger(args.ledger)
+    for l in range(len(df)):
+        ledger.add(str(df.iloc[l]["buoyid"]), str(df.iloc[l]["first_obs"]) +"T00:00", str(df.iloc[l]["last_obs"]) +"T23:59")
+    ledger.save()
+
+    # NOTE: Failed and partial stations of earlier runs get their retries again
+    # (the attempts in the ledger are kept, the tries of this run are counted separately)
+    queue = [station_id for station_id, job in ledger.jobs.items() if job["status"] in ["pending", "failed", "partial"]]
+    tries = {station_id: 0 for station_id in queue}
+    # earliest start of the queued retries
+    not_before = {}
+
+    def retry(station_id):
+        if tries[station_id] <= args.retries:
+            # NOTE: The waiting time is kept here (and not slept in a worker), such that no worker is blocked
+            not_before[station_id] = time.time() + args.backoff*2**(tries[station_id]-1)
+            queue.append(station_id)
+
+    # Fetching data per station
+    while len(queue) > 0:
+        running = {}
+        try:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                while len(queue) > 0 or len(running) > 0:
+                    now = time.time()
+                    for station_id in [s for s in queue if not_before.get(s, 0.0) <= now]:
+                        if len(running) >= args.workers:
+                            break
+                        queue.remove(station_id)
+                        job = ledger.jobs[station_id]
+                        future = executor.submit(build_station, station_id, job["start_time"], job["end_time"], args.format)
+                        running[future] = station_id
+                        tries[station_id] += 1
+                        ledger.update(station_id, status="running", attempts=job["attempts"] + 1)
+
+                    # waiting for a finished station or the next retry that is due
+                    timeout = None
+                    if len(queue) > 0 and len(running) < args.workers:
+                        timeout = max(min(not_before.get(s, 0.0) for s in queue) - time.time(), 0.0)
+                    if len(running) == 0:
+                        time.sleep(timeout)
+                        continue
+                    done, _ = wait(running.keys(), timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        station_id = running.pop(future)
+                        try:
+                            seconds, failures = future.result()
+                            if len(failures) > 0:
+                                ledger.update(station_id, status="partial", seconds=seconds, error=failures)
+                                retry(station_id)
+                            else:
+                                ledger.update(station_id, status="done", seconds=seconds, error=None)
+                        except BrokenProcessPool:
+                            running[future] = station_id
+                            raise
+                        except Exception as err:
+                            ledger.update(station_id, status="failed", error=repr(err))
+                            retry(station_id)
+        except BrokenProcessPool as err:
+            # NOTE: A worker process died (e.g. out of memory),
+            # the stations in progress count as failed attempts and the pool is started again
+            for station_id in running.values():
+                ledger.update(station_id, status="failed", error=repr(err))
+                retry(station_id)
+
+    summary = report(ledger, time.time() - tic)
+    print(summary)
+    with open("download_report.txt", "w") as f:
+        f.write(summary + "\n")
+
 
-# All station information
-df = pd.read_csv("buoys-details.csv").sort_values("N_obs", ascending=False, ignore_index=True)
+if __name__ == "__main__":
 
-# Fetching data per station
-for l in range(len(df)):
     try:
-        start_time = str(df.iloc[l]["first_obs"]) +"T00:00"
-        end_time   = str(df.iloc[l]["last_obs"])  +"T23:59"
-        dataImporter = DataImporter.DataImporter(start_time=start_time, end_time=end_time)
-        dataImporter.constructDataset(station_id=str(df.iloc[l]["buoyid"]))
-    except:
-        pass
+        main()
+    except SystemExit as e:
+        if e.code != 0:
+            print('SystemExit(code={}): {}'.format(e.code, format_exc()), file=sys.stderr)
+            sys.exit(e.code)
+    except: # pylint: disable=bare-except
+        print('error: {}'.format(format_exc()), file=sys.stderr)
+        sys.exit(1)
 
+    sys.exit(0)